@@ -1,11 +1,12 @@
 from django.contrib.auth.models import Group, User
+from django.contrib.sites.models import Site
 from django.contrib import admin
 from django.db import models
 from django.forms import ModelForm, ModelChoiceField
 from django.db.models import Q
 
 from cmsroles.models import Role, get_permission_fields
-from cmsroles.siteadmin import is_site_admin, get_administered_sites
+from cmsroles.siteadmin import is_site_admin, get_administered_site_ids
 from cms.models.permissionmodels import PageUser, PageUserGroup, GlobalPagePermission
 
 
@@ -59,7 +60,10 @@ class UserSetupAdmin(admin.ModelAdmin):
         # should be available only to superusers and to site admins that
         #   have at least one site under their control
         user = request.user
-        return is_site_admin(user) and len(get_administered_sites(user)) > 0
+        if user.is_superuser:
+            return Site.objects.exists()
+        return (is_site_admin(user) and
+                bool(get_administered_site_ids(user)))
 
 
 admin.site.register(Role, RoleAdmin)
@@ -0,0 +1,278 @@
+import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import simplejson, timezone
+
+from cms.models.pagemodel import Page
+
+from cmsroles.models import Role, UserSetupJob
+from cmsroles.utils import chunked
+
+
+class SiteChangeset(object):
+    """The role assignment changes that turn a site's current
+    assignments into the submitted ones.
+
+    Changes are grouped by role so applying them takes a fixed number
+    of batched statements per role, regardless of the number of users.
+    """
+
+    def __init__(self, site, assigned_users=None, submitted_users=None,
+                 user_pages=None):
+        """assigned_users and submitted_users map users to roles and
+        user_pages maps users of non site wide roles to their pages"""
+        self.site = site
+        # role -> users that lose it
+        self.ungrants = {}
+        # site wide role -> users that get it
+        self.grants = {}
+        # non site wide role -> {user: pages}
+        self.page_grants = {}
+        # (user, role) pairs of newly assigned users that can't be granted
+        #   because no pages were submitted for a non site wide role
+        self.skipped = []
+        if submitted_users is not None:
+            self._plan(assigned_users, submitted_users, user_pages)
+
+    def _plan(self, assigned_users, submitted_users, user_pages):
+        unchanged_users = set()
+        for user, role in submitted_users.iteritems():
+            previous_role = assigned_users.get(user, None)
+            pages = user_pages.get(user, None)
+            if role.is_site_wide:
+                if previous_role != role:
+                    self.grants.setdefault(role, []).append(user)
+                else:
+                    unchanged_users.add(user)
+            elif pages is not None:
+                self.page_grants.setdefault(role, {})[user] = pages
+                if previous_role == role:
+                    unchanged_users.add(user)
+            elif previous_role == role:
+                unchanged_users.add(user)
+            elif previous_role is None:
+                # this is very unlikely but can happen if someone changes
+                # the role between the moment user setup page is rendered
+                # and the moment the forms are submitted
+                self.skipped.append((user, role))
+            else:
+                raise ValidationError('At lest a page must be given')
+        for user, role in assigned_users.iteritems():
+            if user not in unchanged_users:
+                self.ungrants.setdefault(role, []).append(user)
+        self._drop_unchanged_page_grants(assigned_users)
+
+    def _drop_unchanged_page_grants(self, assigned_users):
+        """Leaves out the users that keep their page based role and
+        whose submitted pages are the ones they already have"""
+        for role, user_pages in self.page_grants.items():
+            kept_users = [user for user in user_pages
+                          if assigned_users.get(user, None) == role]
+            if not kept_users:
+                continue
+            current_pages = {}
+            for pk, (user_id, page_id) in role._get_users_page_perms(
+                    [user.pk for user in kept_users], self.site):
+                current_pages.setdefault(user_id, set()).add(page_id)
+            for user in kept_users:
+                if current_pages.get(user.pk, set()) == \
+                        set(page.pk for page in user_pages[user]):
+                    del user_pages[user]
+            if not user_pages:
+                del self.page_grants[role]
+
+    def __len__(self):
+        """The number of users that get changed"""
+        return sum(len(users) for changes in
+                   (self.ungrants, self.grants, self.page_grants)
+                   for users in changes.itervalues())
+
+    def get_operations(self):
+        operations = []
+        for action, changes in (('ungrant', self.ungrants),
+                                ('grant', self.grants),
+                                ('grant_pages', self.page_grants)):
+            for role, users in sorted(changes.iteritems(),
+                                      key=lambda item: item[0].pk):
+                operations.append({
+                        'action': action,
+                        'role': role.name,
+                        'users': sorted(user.username for user in users)})
+        return operations
+
+    def apply(self, dry_run=False):
+        """Applies the changes and returns a summary of the operations.
+        With dry_run the summary is built without touching the database.
+        The number of queries the changes took is only counted when
+        settings.DEBUG is on, as that's when queries get recorded, and
+        is None otherwise.
+        """
+        queries = 0
+        if not dry_run:
+            count_queries = settings.DEBUG
+            starting_queries = len(connection.queries)
+            for role, users in self.ungrants.iteritems():
+                role.ungrant_from_users(users, self.site)
+            for role, users in self.grants.iteritems():
+                role.grant_to_users(users, self.site)
+            for role, user_pages in self.page_grants.iteritems():
+                role.grant_pages_to_users(user_pages, self.site)
+            if count_queries:
+                queries = len(connection.queries) - starting_queries
+            else:
+                queries = None
+        return {'dry_run': dry_run,
+                'operations': self.get_operations(),
+                'skipped': [(user.username, role.name)
+                            for user, role in self.skipped],
+                'queries': queries}
+
+    def _get_steps(self):
+        steps = []
+        for role, users in self.ungrants.iteritems():
+            steps.append((role.ungrant_from_users, users))
+        for role, users in self.grants.iteritems():
+            steps.append((role.grant_to_users, users))
+        for role, user_pages in self.page_grants.iteritems():
+            steps.append((
+                    lambda items, site, role=role:
+                        role.grant_pages_to_users(dict(items), site),
+                    user_pages.items()))
+        return steps
+
+    def apply_in_chunks(self, chunk_size=100, progress=None,
+                        before_chunk=None):
+        """Applies the changes in chunks of at most chunk_size users, each
+        chunk in its own transaction. progress gets called with the
+        number of changed users after each chunk and before_chunk, if
+        given, right before each chunk gets applied.
+        """
+        done = 0
+        for apply_step, items in self._get_steps():
+            for items_chunk in chunked(items, chunk_size):
+                if before_chunk is not None:
+                    before_chunk()
+                with transaction.commit_on_success():
+                    apply_step(items_chunk, self.site)
+                done += len(items_chunk)
+                if progress is not None:
+                    progress(done)
+        return done
+
+    def to_json(self):
+        return simplejson.dumps({
+            'ungrants': dict((role.pk, [user.pk for user in users])
+                             for role, users in self.ungrants.iteritems()),
+            'grants': dict((role.pk, [user.pk for user in users])
+                           for role, users in self.grants.iteritems()),
+            'page_grants': dict(
+                (role.pk, dict((user.pk, [page.pk for page in pages])
+                               for user, pages in user_pages.iteritems()))
+                for role, user_pages in self.page_grants.iteritems())})
+
+    @classmethod
+    def from_json(cls, site, data):
+        """Rebuilds a changeset serialized with to_json. Roles, users and
+        pages are loaded with one query per chunk of ids and the ones
+        that got deleted in the meanwhile are left out.
+        """
+        data = simplejson.loads(data)
+        role_ids, user_ids, page_ids = set(), set(), set()
+        for key in ('ungrants', 'grants', 'page_grants'):
+            for role_id, users in data[key].iteritems():
+                role_ids.add(int(role_id))
+                user_ids.update(int(user_id) for user_id in users)
+        for user_pages in data['page_grants'].itervalues():
+            for pages in user_pages.itervalues():
+                page_ids.update(pages)
+
+        def load(model, ids):
+            objs = {}
+            for ids_chunk in chunked(ids):
+                objs.update(model.objects.in_bulk(ids_chunk))
+            return objs
+
+        roles = load(Role, role_ids)
+        users = load(User, user_ids)
+        pages = load(Page, page_ids)
+        changeset = cls(site)
+        for key in ('ungrants', 'grants'):
+            changes = getattr(changeset, key)
+            for role_id, role_users in data[key].iteritems():
+                role = roles.get(int(role_id), None)
+                if role is not None:
+                    changes[role] = [users[user_id] for user_id in role_users
+                                     if user_id in users]
+        for role_id, user_pages in data['page_grants'].iteritems():
+            role = roles.get(int(role_id), None)
+            if role is None:
+                continue
+            for user_id, user_page_ids in user_pages.iteritems():
+                user = users.get(int(user_id), None)
+                if user is None:
+                    continue
+                granted_pages = [pages[page_id] for page_id in user_page_ids
+                                 if page_id in pages]
+                if granted_pages:
+                    changeset.page_grants.setdefault(role, {})[user] = \
+                        granted_pages
+                else:
+                    # all of the user's pages got deleted in the meanwhile
+                    changeset.skipped.append((user, role))
+        return changeset
+
+
+def run_user_setup_job(job, chunk_size=100):
+    """Applies a pending job's changeset in chunked transactions, while
+    keeping track of its progress. Returns False if some other worker
+    already picked up the job.
+    """
+    claimed = UserSetupJob.objects.filter(
+        pk=job.pk, status=UserSetupJob.PENDING).update(
+        status=UserSetupJob.RUNNING, heartbeat=timezone.now())
+    if not claimed:
+        return False
+
+    def progress(done):
+        UserSetupJob.objects.filter(pk=job.pk).update(
+            done=done, heartbeat=timezone.now())
+
+    # touched right before each chunk as well, so the time spent loading
+    #   the changeset isn't counted against the first chunk
+    def touch():
+        UserSetupJob.objects.filter(pk=job.pk).update(
+            heartbeat=timezone.now())
+
+    try:
+        changeset = SiteChangeset.from_json(job.site, job.changes)
+        changeset.apply_in_chunks(chunk_size, progress, touch)
+    except Exception, e:
+        UserSetupJob.objects.filter(pk=job.pk).update(
+            status=UserSetupJob.FAILED, error=unicode(e))
+    else:
+        error = u''
+        if changeset.skipped:
+            error = u'Users skipped because their pages got deleted: %s' % (
+                u', '.join(sorted(user.username
+                                  for user, role in changeset.skipped)))
+        UserSetupJob.objects.filter(pk=job.pk).update(
+            status=UserSetupJob.DONE, error=error)
+    return True
+
+
+def reclaim_stale_user_setup_jobs(stale_after):
+    """Puts back the running jobs whose heartbeat is older than
+    stale_after seconds, as their worker most likely died. Jobs can be
+    applied again from the start since a changeset describes the
+    assignments the site should end up with. Returns the number of
+    reclaimed jobs.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=stale_after)
+    return UserSetupJob.objects.filter(
+        Q(heartbeat__lt=cutoff) | Q(heartbeat__isnull=True),
+        status=UserSetupJob.RUNNING).update(
+        status=UserSetupJob.PENDING, done=0)
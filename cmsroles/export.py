@@ -0,0 +1,107 @@
+import csv
+from cStringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.utils import simplejson
+from django.utils.encoding import smart_str
+
+from cmsroles.models import Role
+from cmsroles.utils import chunked
+
+
+# the values of each exported assignment; page is empty for site wide roles
+EXPORT_FIELDS = ('user', 'site', 'role', 'page')
+
+
+def _iter_by_pk(queryset, fields, chunk_size):
+    """Yields the values_list rows of queryset in pk order, fetching
+    chunk_size rows per query. Every query seeks past the last seen pk,
+    so memory use doesn't depend on the total number of rows.
+    """
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                    .values_list('pk', *fields)[:chunk_size])
+        for row in rows:
+            yield row[1:]
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1][0]
+
+
+def _iter_site_assignments(site_ids, role_ids, chunk_size):
+    # all conditions go in a single filter call, otherwise each call
+    #   would add its own join chain through the multi-valued relations
+    site_wide_filters = {
+        'group__globalpagepermission__role__isnull': False,
+        'group__globalpagepermission__sites__isnull': False}
+    page_filters = {'pagepermission__user__isnull': False}
+    if site_ids is not None:
+        site_wide_filters['group__globalpagepermission__sites__in'] = site_ids
+        page_filters['pagepermission__page__site__in'] = site_ids
+    if role_ids is not None:
+        site_wide_filters['group__globalpagepermission__role__in'] = role_ids
+        page_filters['role__in'] = role_ids
+    site_wide_q = User.groups.through.objects.filter(**site_wide_filters)
+    page_q = Role.derived_page_permissions.through.objects.filter(
+        **page_filters)
+    # the site wide rows get ids since selecting the names would join the
+    #   site and role tables once more
+    domains = Site.objects.all()
+    if site_ids is not None:
+        domains = domains.filter(pk__in=site_ids)
+    domains = dict(domains.values_list('pk', 'domain'))
+    role_names = dict(Role.objects.values_list('pk', 'name'))
+    for user, site_id, role_id in _iter_by_pk(
+            site_wide_q, ('user__username',
+                          'group__globalpagepermission__sites',
+                          'group__globalpagepermission__role'),
+            chunk_size):
+        yield user, domains[site_id], role_names[role_id], None
+    for row in _iter_by_pk(
+            page_q, ('pagepermission__user__username',
+                     'pagepermission__page__site__domain', 'role__name',
+                     'pagepermission__page'),
+            chunk_size):
+        yield row
+
+
+def iter_assignments(site_ids=None, role_ids=None, chunk_size=1000):
+    """Yields a (username, site domain, role name, page pk) tuple for
+    each role assignment, optionally only for the given sites and roles.
+    Site wide roles yield a single row per user and site, with None as
+    the page, while page based roles yield one row per granted page.
+    """
+    if site_ids is None:
+        return _iter_site_assignments(None, role_ids, chunk_size)
+    return (row for site_ids_chunk in chunked(site_ids)
+            for row in _iter_site_assignments(
+                site_ids_chunk, role_ids, chunk_size))
+
+
+def iter_csv_lines(rows):
+    """Yields the header and then rows as utf-8 encoded CSV lines"""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(['' if value is None else smart_str(value)
+                         for value in row])
+    yield buf.getvalue()
+
+
+def iter_jsonl_lines(rows):
+    """Yields rows as JSON objects, one per line"""
+    for row in rows:
+        yield simplejson.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n'
+
+
+# format -> (line generator, content type)
+EXPORT_FORMATS = {
+    'csv': (iter_csv_lines, 'text/csv'),
+    'jsonl': (iter_jsonl_lines, 'application/x-ndjson'),
+}
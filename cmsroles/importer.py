@@ -0,0 +1,219 @@
+import csv
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.utils import simplejson
+
+from cms.models.pagemodel import Page
+
+from cmsroles.export import EXPORT_FIELDS
+from cmsroles.models import Role
+from cmsroles.utils import chunked
+
+
+def iter_csv_rows(lines):
+    """Yields (line number, row) pairs from CSV lines having a header
+    with the EXPORT_FIELDS columns"""
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, dict(
+            (key, value.decode('utf-8'))
+            for key, value in row.iteritems()
+            if key is not None and value is not None)
+
+
+def iter_jsonl_rows(lines):
+    """Yields (line number, row) pairs from lines holding a JSON object
+    each. Blank lines are skipped."""
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = simplejson.loads(line)
+        except ValueError:
+            row = None
+        yield line_num, row
+
+
+# format -> row reader
+IMPORT_FORMATS = {
+    'csv': iter_csv_rows,
+    'jsonl': iter_jsonl_rows,
+}
+
+
+def _parse_row(row):
+    """Returns the (username, site domain, role name, page pk) tuple of
+    a row or raises ValueError with the reason it can't be used"""
+    if not isinstance(row, dict):
+        raise ValueError(u'malformed row')
+    values = []
+    for field in EXPORT_FIELDS[:3]:
+        value = row.get(field, None)
+        if not isinstance(value, basestring) or not value.strip():
+            raise ValueError(u'missing %s' % field)
+        values.append(value.strip())
+    page = row.get('page', None)
+    if page is None or page == '':
+        values.append(None)
+    else:
+        try:
+            values.append(int(page))
+        except (TypeError, ValueError):
+            raise ValueError(u'invalid page %r' % page)
+    return tuple(values)
+
+
+class AssignmentImporter(object):
+    """Grants roles given (username, site domain, role name, page pk)
+    rows, a chunk of rows at a time.
+
+    Each chunk is resolved with a fixed number of batched lookups and
+    its grants are applied through the roles' bulk methods in a single
+    transaction. Rows that are already in place are skipped, so
+    importing the same rows again only takes the lookups. Only roles are
+    granted: users keep their other assignments, and rows giving users a
+    second role on the same site are rejected.
+    """
+
+    def __init__(self, chunk_size=500, progress=None):
+        self.chunk_size = chunk_size
+        # called with the number of rows seen after each chunk
+        self.progress = progress
+        # sites and roles are few so they are looked up only once
+        self.sites = {}
+        self.roles = {}
+        self.rows = 0
+        self.granted = 0
+        self.unchanged = 0
+        # (line number, reason) pairs
+        self.rejected = []
+
+    def run(self, rows):
+        """Imports the (line number, row) pairs yielded by rows"""
+        for rows_chunk in chunked(rows, self.chunk_size):
+            self._import_chunk(rows_chunk)
+            self.rows += len(rows_chunk)
+            if self.progress is not None:
+                self.progress(self.rows)
+        return self.get_report()
+
+    def get_report(self):
+        return {'rows': self.rows,
+                'granted': self.granted,
+                'unchanged': self.unchanged,
+                'rejected': sorted(self.rejected)}
+
+    def _load_missing(self, objs, model, field, values):
+        missing = set(values) - set(objs)
+        for values_chunk in chunked(missing):
+            objs.update(
+                (getattr(obj, field), obj) for obj in
+                model.objects.filter(**{'%s__in' % field: values_chunk}))
+
+    def _get_current_assignments(self, user_ids, site_ids):
+        """Returns a (user id, site id) -> role id mapping and the set of
+        (user id, page id) pairs of the page based roles"""
+        roles = {}
+        pages = set()
+        UserGroup = User.groups.through
+        RolePagePerm = Role.derived_page_permissions.through
+        for user_ids_chunk in chunked(user_ids):
+            roles.update(
+                ((user_id, site_id), role_id)
+                for user_id, site_id, role_id in UserGroup.objects.filter(
+                    user__in=user_ids_chunk,
+                    group__globalpagepermission__role__isnull=False,
+                    group__globalpagepermission__sites__in=site_ids)
+                .values_list('user', 'group__globalpagepermission__sites',
+                             'group__globalpagepermission__role'))
+            for user_id, site_id, role_id, page_id in \
+                    RolePagePerm.objects.filter(
+                        pagepermission__user__in=user_ids_chunk,
+                        pagepermission__page__site__in=site_ids)\
+                    .values_list('pagepermission__user',
+                                 'pagepermission__page__site', 'role',
+                                 'pagepermission__page'):
+                roles[user_id, site_id] = role_id
+                pages.add((user_id, page_id))
+        return roles, pages
+
+    def _import_chunk(self, rows):
+        parsed = []
+        for line_num, row in rows:
+            try:
+                parsed.append((line_num, _parse_row(row)))
+            except ValueError, e:
+                self.rejected.append((line_num, unicode(e)))
+        users = {}
+        self._load_missing(users, User, 'username',
+                           set(row[0] for line_num, row in parsed))
+        self._load_missing(self.sites, Site, 'domain',
+                           set(row[1] for line_num, row in parsed))
+        self._load_missing(self.roles, Role, 'name',
+                           set(row[2] for line_num, row in parsed))
+        pages = {}
+        for page_ids in chunked(set(row[3] for line_num, row in parsed
+                                    if row[3] is not None)):
+            pages.update(Page.objects.in_bulk(page_ids))
+
+        valid = []
+        for line_num, (username, domain, role_name, page_id) in parsed:
+            user = users.get(username, None)
+            site = self.sites.get(domain, None)
+            role = self.roles.get(role_name, None)
+            page = pages.get(page_id, None)
+            if user is None:
+                reason = u'unknown user %s' % username
+            elif site is None:
+                reason = u'unknown site %s' % domain
+            elif role is None:
+                reason = u'unknown role %s' % role_name
+            elif role.is_site_wide and page_id is not None:
+                reason = u'role %s is site wide and takes no page' % role.name
+            elif not role.is_site_wide and page_id is None:
+                reason = u'role %s needs a page' % role.name
+            elif page_id is not None and (page is None or
+                                          page.site_id != site.pk):
+                reason = u'unknown page %s on site %s' % (page_id, domain)
+            else:
+                valid.append((line_num, user, site, role, page))
+                continue
+            self.rejected.append((line_num, reason))
+        if not valid:
+            return
+
+        current_roles, current_pages = self._get_current_assignments(
+            set(user.pk for line_num, user, site, role, page in valid),
+            set(site.pk for line_num, user, site, role, page in valid))
+        # (role, site) -> users and (role, site) -> {user: pages}
+        grants = {}
+        page_grants = {}
+        for line_num, user, site, role, page in valid:
+            # rows granted by this chunk count as current for the next ones
+            current_role_id = current_roles.get((user.pk, site.pk), None)
+            if current_role_id not in (None, role.pk):
+                self.rejected.append((line_num, (
+                            u'user %s already has another role on site %s'
+                            % (user.username, site.domain))))
+            elif page is None and current_role_id is not None:
+                self.unchanged += 1
+            elif page is None:
+                current_roles[user.pk, site.pk] = role.pk
+                grants.setdefault((role, site), []).append(user)
+                self.granted += 1
+            elif (user.pk, page.pk) in current_pages:
+                self.unchanged += 1
+            else:
+                current_roles[user.pk, site.pk] = role.pk
+                current_pages.add((user.pk, page.pk))
+                page_grants.setdefault((role, site), {})\
+                    .setdefault(user, []).append(page)
+                self.granted += 1
+        with transaction.commit_on_success():
+            for (role, site), site_users in grants.iteritems():
+                role.grant_to_users(site_users, site)
+            for (role, site), user_pages in page_grants.iteritems():
+                role.grant_pages_to_users(user_pages, site,
+                                          keep_existing=True)
@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cmsroles.models import Role
+
+
+class Command(BaseCommand):
+
+    help = u'Switches a role between being site wide and functioning ' +\
+        'on a page by page basis, moving all of its users in bulk. ' +\
+        'Meant for roles that have too many users for the conversion ' +\
+        'to be done from the admin.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--role', dest='role',
+            help='Which role should be converted'),
+        make_option('--site-wide', dest='is_site_wide',
+            action='store_true', default=None,
+            help='Make the role site wide'),
+        make_option('--page-based', dest='is_site_wide',
+            action='store_false',
+            help='Make the role function on a page by page basis'),
+        )
+
+    def handle(self, *args, **options):
+        is_site_wide = options['is_site_wide']
+        if is_site_wide is None:
+            raise CommandError('One of --site-wide or --page-based is required')
+        role = Role.objects.get(name=options['role'])
+        if role.is_site_wide == is_site_wide:
+            raise CommandError(u'Role %s is already %s' % (
+                    role.name, 'site wide' if is_site_wide else 'page based'))
+        with transaction.commit_on_success():
+            role.is_site_wide = is_site_wide
+            role.save()
+        self.report = role.conversion_report
+        for key, value in sorted(self.report.iteritems()):
+            if key != 'lost_users':
+                self.stdout.write(u'%s: %s\n' % (key, value))
+        for user_id, site_id in self.report['lost_users']:
+            self.stdout.write(
+                u'User %s lost role %s on site %s because the site has no '
+                'pages\n' % (user_id, role.name, site_id))
@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+
+from cmsroles.export import EXPORT_FORMATS, iter_assignments
+from cmsroles.models import Role
+
+
+def _get_pks(model, field, values):
+    pks = dict(model.objects.filter(**{'%s__in' % field: values})
+               .values_list(field, 'pk'))
+    missing = set(values) - set(pks)
+    if missing:
+        raise CommandError(u'Unknown %s: %s' % (
+                model._meta.verbose_name, u', '.join(sorted(missing))))
+    return pks.values()
+
+
+class Command(BaseCommand):
+
+    help = u'Writes the role assignments of all users to the standard ' +\
+        'output, one line per user, site and role (or per page, for page ' +\
+        'based roles). Assignments are read in chunks so the memory used ' +\
+        'stays the same regardless of their number.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+            choices=sorted(EXPORT_FORMATS),
+            help='Output format: csv or jsonl'),
+        make_option('--site', dest='sites', action='append',
+            help='Only export the site having this domain. Can be repeated'),
+        make_option('--role', dest='roles', action='append',
+            help='Only export the role having this name. Can be repeated'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=1000,
+            help='How many assignments get read with a single query'),
+        )
+
+    def handle(self, *args, **options):
+        site_ids = role_ids = None
+        if options['sites']:
+            site_ids = _get_pks(Site, 'domain', options['sites'])
+        if options['roles']:
+            role_ids = _get_pks(Role, 'name', options['roles'])
+        iter_lines, content_type = EXPORT_FORMATS[options['format']]
+        rows = iter_assignments(site_ids, role_ids, options['chunk_size'])
+        for line in iter_lines(rows):
+            self.stdout.write(line)
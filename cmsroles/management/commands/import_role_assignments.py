@@ -0,0 +1,52 @@
+from optparse import make_option
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cmsroles.importer import IMPORT_FORMATS, AssignmentImporter
+
+
+class Command(BaseCommand):
+
+    args = '<file>'
+
+    help = u'Grants the roles listed in a CSV or JSON Lines file having ' +\
+        'user, site, role and page columns, like the ones written by ' +\
+        'export_role_assignments. The file is read in chunks of rows and ' +\
+        'each chunk is applied in its own transaction. Rows that are ' +\
+        'already in place are skipped so the same file can be imported ' +\
+        'again.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            choices=sorted(IMPORT_FORMATS),
+            help='Input format: csv or jsonl. Guessed from the file ' +
+                 'extension by default'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=500,
+            help='How many rows get applied in a single transaction'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('A single file is required')
+        path = args[0]
+        format = options['format']
+        if format is None:
+            format = os.path.splitext(path)[1].lstrip('.').lower()
+            if format not in IMPORT_FORMATS:
+                raise CommandError(u'Unknown format of %s, use --format' % path)
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(rows):
+            if verbosity > 1:
+                self.stdout.write(u'%d rows processed\n' % rows)
+
+        importer = AssignmentImporter(options['chunk_size'], progress)
+        with open(path, 'rb') as lines:
+            self.report = importer.run(IMPORT_FORMATS[format](lines))
+        for line_num, reason in self.report['rejected']:
+            self.stdout.write(u'Line %d rejected: %s\n' % (line_num, reason))
+        self.stdout.write(u'rows: %(rows)d, granted: %(granted)d, '
+                          'unchanged: %(unchanged)d, ' % self.report +
+                          u'rejected: %d\n' % len(self.report['rejected']))
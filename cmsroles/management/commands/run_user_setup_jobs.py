@@ -0,0 +1,49 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from cmsroles.changeset import reclaim_stale_user_setup_jobs, \
+    run_user_setup_job
+from cmsroles.models import UserSetupJob
+
+
+class Command(BaseCommand):
+
+    help = u'Applies the pending user setup submissions that were too ' +\
+        'large to be applied while serving the request. Each job is ' +\
+        'applied in chunks of users, every chunk in its own transaction.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=100,
+            help='How many users get changed in a single transaction'),
+        make_option('--loop', dest='loop', action='store_true',
+            default=False,
+            help='Keep polling for new jobs instead of exiting'),
+        make_option('--interval', dest='interval', type='int', default=5,
+            help='Seconds to wait between polls when using --loop'),
+        make_option('--stale-after', dest='stale_after', type='int',
+            default=600,
+            help='Seconds after which running jobs that made no progress ' +
+                 'are considered abandoned and get applied again'),
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            reclaimed = reclaim_stale_user_setup_jobs(options['stale_after'])
+            if reclaimed:
+                self.stdout.write(u'Reclaimed %d abandoned jobs\n' % reclaimed)
+            pending_jobs = UserSetupJob.objects.filter(
+                status=UserSetupJob.PENDING).select_related('site')
+            for job in pending_jobs:
+                if run_user_setup_job(job, options['chunk_size']):
+                    job = UserSetupJob.objects.get(pk=job.pk)
+                    self.stdout.write(u'Job %d: %s\n' % (job.pk, job))
+            if not options['loop']:
+                break
+            # ends the poll's transaction, otherwise backends using
+            #   repeatable reads would never see new jobs
+            connection.close()
+            time.sleep(options['interval'])
@@ -1,17 +1,25 @@
 from django.contrib.auth.models import User, Group
 from django.contrib.sites.models import Site
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import signals, Q
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+from cms.cache.permissions import clear_permission_cache
 from cms.models.permissionmodels import (
     AbstractPagePermission, GlobalPagePermission, PagePermission)
 from cms.models import ACCESS_PAGE_AND_DESCENDANTS
 from cms.models.pagemodel import Page
 
+from cmsroles.utils import bulk_create, chunked, delete_in_bulk, \
+    MAX_IN_CLAUSE_SIZE
+
 import logging
+import uuid
 logger = logging.getLogger(__name__)
 
 
@@ -65,14 +73,21 @@ class Role(AbstractPagePermission):
     derived_page_permissions = models.ManyToManyField(
         PagePermission, blank=True, null=True)
 
+    # describes what the last is_site_wide change did to the users
+    conversion_report = None
+
     def __unicode__(self):
         return self.name
 
     def __init__(self, *args, **kwargs):
         super(Role, self).__init__(*args, **kwargs)
+        self._track_old_values()
+
+    def _track_old_values(self):
         self._old_group = self.group_id
         self._old_is_site_wide = self.is_site_wide
         self._old_name = self.name
+        self._old_permissions = self._get_permissions_dict()
 
     def clean(self):
         if self.group is not None:
@@ -86,32 +101,58 @@ class Role(AbstractPagePermission):
                 raise ValidationError(u'A Role for group "%s" already exists' % self.group.name)
 
     def update_site_groups(self, update_names, update_permissions):
+        site_groups = {}
+        for group_id, group_name, domain in self.derived_global_permissions\
+                .filter(group__isnull=False)\
+                .values_list('group', 'group__name', 'sites__domain'):
+            site_groups.setdefault(group_id, (group_name, domain))
+
         if update_permissions:
-            new_group_permissions = self.group.permissions.all()
-
-        global_perm_q = self.derived_global_permissions.select_related(
-            'group', 'sites')
-        site_groups = [(global_perm.group, global_perm.sites.all()[0])
-                       for global_perm in global_perm_q]
-        for group, site in site_groups:
-            if update_permissions:
-                group.permissions = new_group_permissions
-
-            if update_names:
-                group.name = Role.group_name_pattern % {
-                    'role_name': self.name,
-                    'site_domain': site.domain}
-                group.save()
+            self._sync_site_group_permissions(site_groups.keys())
+
+        if update_names:
+            new_names = {}
+            for group_id, (group_name, domain) in site_groups.iteritems():
+                if domain is None:
+                    continue
+                new_name = self.get_site_group_name(domain)
+                if new_name != group_name:
+                    new_names[group_id] = new_name
+            update_group_names(new_names)
+
+    def _sync_site_group_permissions(self, site_group_ids):
+        """Makes the site groups have the same permissions as the base
+        group by only adding and removing the differing rows"""
+        GroupPermission = Group.permissions.through
+        new_perms = set(self.group.permissions.values_list('id', flat=True))
+        site_group_perms_q = GroupPermission.objects.filter(
+            group__globalpagepermission__role=self)
+        current_perms = {}
+        for group_id, perm_id in site_group_perms_q.values_list(
+                'group_id', 'permission_id'):
+            current_perms.setdefault(group_id, set()).add(perm_id)
+        bulk_create(GroupPermission, [
+            GroupPermission(group_id=group_id, permission_id=perm_id)
+            for group_id in site_group_ids
+            for perm_id in new_perms - current_perms.get(group_id, set())])
+        if any(group_perms - new_perms
+               for group_perms in current_perms.itervalues()):
+            site_group_perms_q.exclude(permission__in=new_perms).delete()
+        clear_permission_cache()
+        # the site admin permission might have been added or removed
+        bump_administered_sites_version()
 
     def _propagate_perm_changes(self, derived_perms):
-        permissions = self._get_permissions_dict()
-        for gp in derived_perms:
-            for key, value in permissions.iteritems():
-                setattr(gp, key, value)
-            gp.save()
+        derived_perms.update(**self._get_permissions_dict())
+        # the update bypasses the cms' pre_save signals that
+        #   would have invalidated its permission cache
+        clear_permission_cache()
 
     def save(self, *args, **kwargs):
+        created = self.pk is None
         super(Role, self).save(*args, **kwargs)
+        permissions_changed = (
+            self._old_permissions != self._get_permissions_dict())
         if self.is_site_wide:
             group_changed = (self._old_group is not None and
                              self._old_group != self.group_id)
@@ -120,107 +161,267 @@ class Role(AbstractPagePermission):
                 self.update_site_groups(
                     update_names=True,
                     update_permissions=group_changed)
-            # TODO: improve performance by having less queries
             derived_global_permissions = self.derived_global_permissions.all()
-            covered_sites = set(derived_global_permissions.values_list('sites', flat=True))
-            for site in Site.objects.exclude(pk__in=covered_sites):
-                self.add_site_specific_global_page_perm(site)
-            self._propagate_perm_changes(derived_global_permissions)
-        else:
+            # the global page permissions that get created below already
+            #   have the role's permissions, no need to propagate on them
+            if permissions_changed:
+                self._propagate_perm_changes(derived_global_permissions)
+            uncovered_sites = Site.objects.exclude(
+                pk__in=derived_global_permissions.values('sites'))
+            self.add_site_specific_global_page_perms(uncovered_sites)
+        elif permissions_changed:
             self._propagate_perm_changes(self.derived_page_permissions.all())
 
         if self.is_site_wide != self._old_is_site_wide:
             if self.is_site_wide:
-                for page_perm in self.derived_page_permissions.all():
-                    self.grant_to_user(page_perm.user, page_perm.page.site)
-                    page_perm.delete()
+                self.conversion_report = self._convert_to_site_wide()
             else:
-                for global_page_perm in self.derived_global_permissions.all():
-                    sites = global_page_perm.sites.all()
-                    if len(sites) != 1:
-                        logger.error(u'Auto generated global page permission was fiddled')
-                        continue
-                    site = sites[0]
-                    users = global_page_perm.group.user_set.all()
-                    try:
-                        first_page = Page.objects.filter(site=site)\
-                            .order_by('tree_id', 'lft')[0]
-                    except IndexError:
-                        if len(users) > 0:
-                            users_str = ', '.join(list(users))
-                            logger.error(u'Users %s lost role %s on site %s after '
-                                           'making the site non site wide' % (
-                                    users_str, self.name, site.domain))
-                    else:
-                        for user in users:
-                            self.grant_to_user(user, site, [first_page])
-                    global_page_perm.group.delete()
+                self.conversion_report = self._convert_to_page_based()
+        if created or (self.is_site_wide != self._old_is_site_wide or
+                       self.name != self._old_name):
+            # the roles that can be assigned on any site or the users
+            #   of this role on all of its sites changed
+            bump_site_versions()
+        self._track_old_values()
+
+    def _convert_to_site_wide(self):
+        """Moves the users of the derived page permissions into the site
+        groups of the sites those pages belong to. The site groups need
+        to be already provisioned."""
+        report = _new_conversion_report()
+        site_groups = dict(
+            self.derived_global_permissions.values_list('sites', 'group'))
+        page_perms = list(self.derived_page_permissions.values_list(
+                'pk', 'user', 'page__site'))
+        memberships = set(
+            (user_id, site_groups[site_id])
+            for page_perm_pk, user_id, site_id in page_perms
+            if user_id is not None and site_id in site_groups)
+        report['memberships_added'] = add_group_memberships(memberships)
+        flag_staff(set(user_id for user_id, group_id in memberships))
+        report['page_permissions_deleted'] = self._delete_derived_page_perms(
+            [page_perm_pk for page_perm_pk, user_id, site_id in page_perms])
+        report['users'] = len(memberships)
+        return report
+
+    def _convert_to_page_based(self):
+        """Gives each user of a site group a page permission on the site's
+        first page and then deletes the site groups"""
+        report = _new_conversion_report()
+        global_perms = {}
+        for global_perm_pk, group_id, site_id in self.derived_global_permissions\
+                .values_list('pk', 'group', 'sites'):
+            global_perms.setdefault(global_perm_pk, (group_id, []))[1].append(site_id)
+        group_sites = {}
+        for group_id, site_ids in global_perms.itervalues():
+            if group_id is None or len(site_ids) != 1 or site_ids[0] is None:
+                logger.error(u'Auto generated global page permission was fiddled')
+                continue
+            group_sites[group_id] = site_ids[0]
+
+        first_pages = {}
+        for site_ids in chunked(group_sites.values()):
+            # the first page of a site is the root with the lowest tree_id
+            roots = Page.objects.filter(site__in=site_ids, parent__isnull=True)\
+                .order_by('-tree_id').values_list('site', 'pk')
+            first_pages.update(roots)
+
+        user_pages = []
+        for group_ids in chunked(group_sites):
+            for group_id, user_id in User.groups.through.objects.filter(
+                    group__in=group_ids).values_list('group', 'user'):
+                site_id = group_sites[group_id]
+                if site_id in first_pages:
+                    user_pages.append((user_id, first_pages[site_id]))
+                else:
+                    report['lost_users'].append((user_id, site_id))
+        for user_id, site_id in report['lost_users']:
+            logger.error(u'User %s lost role %s on site %s after making '
+                         'the role non site wide' % (user_id, self.name, site_id))
+
+        user_ids = set(user_id for user_id, page_id in user_pages)
+        report['page_permissions_created'] = len(
+            self._create_derived_page_perms(user_pages))
+        report['memberships_added'] = add_group_memberships(
+            (user_id, self.group_id) for user_id in user_ids)
+        flag_staff(user_ids)
+        report['site_groups_deleted'] = delete_groups(group_sites.keys())
+        report['users'] = len(user_ids)
+        return report
+
+    def _create_derived_page_perms(self, user_pages):
+        """Bulk creates page permissions carrying this role's permissions
+        for the given (user_id, page_id) pairs and adds them to
+        derived_page_permissions. Returns the pks of the new objects.
+        """
+        user_pages = set(user_pages)
+        if not user_pages:
+            return []
+        page_ids = set(page_id for user_id, page_id in user_pages)
+
+        def existing_perms():
+            perms = {}
+            for page_ids_chunk in chunked(page_ids):
+                perms.update(
+                    (pk, (user_id, page_id)) for pk, user_id, page_id in
+                    PagePermission.objects.filter(page__in=page_ids_chunk)
+                    .values_list('pk', 'user', 'page'))
+            return perms
+
+        # bulk_create doesn't return pks so the new objects are found
+        #   by looking at what wasn't there before
+        old_perms = existing_perms()
+        permissions = self._get_permissions_dict()
+        bulk_create(PagePermission, [
+            PagePermission(user_id=user_id, page_id=page_id,
+                           grant_on=ACCESS_PAGE_AND_DESCENDANTS, **permissions)
+            for user_id, page_id in user_pages])
+        new_perm_pks = [
+            pk for pk, user_page in existing_perms().iteritems()
+            if pk not in old_perms and user_page in user_pages]
+        bulk_create(Role.derived_page_permissions.through, [
+            Role.derived_page_permissions.through(
+                role_id=self.pk, pagepermission_id=pk)
+            for pk in new_perm_pks])
+        clear_permission_cache()
+        return new_perm_pks
+
+    def _delete_derived_page_perms(self, page_perm_pks):
+        """Deletes the given derived page permissions together with
+        their derived_page_permissions rows. Returns the number of
+        deleted page permissions."""
+        deleted = 0
+        for pks in chunked(page_perm_pks):
+            delete_in_bulk(Role.derived_page_permissions.through.objects
+                           .filter(role=self, pagepermission__in=pks))
+            deleted += delete_in_bulk(PagePermission.objects.filter(pk__in=pks))
+        if deleted:
+            clear_permission_cache()
+        return deleted
 
     def delete(self, *args, **kwargs):
-        for global_perm in self.derived_global_permissions.all():
-            # global_perm will also get deleted by cascading from global_perm.group
-            global_perm.group.delete()
-        for page_perm in self.derived_page_permissions.all():
-            page_perm.delete()
+        # the global page permissions will also get deleted with their groups
+        delete_groups(list(self.derived_global_permissions
+                           .filter(group__isnull=False)
+                           .values_list('group', flat=True)))
+        # derived global permissions that lost their group
+        delete_global_page_perms(list(
+                self.derived_global_permissions.values_list('pk', flat=True)))
+        self._delete_derived_page_perms(list(
+                self.derived_page_permissions.values_list('pk', flat=True)))
+        bump_site_versions()
         return super(Role, self).delete(*args, **kwargs)
 
     def _get_permissions_dict(self):
         return dict((key, getattr(self, key))
                     for key in get_permission_fields())
 
-    def add_site_specific_global_page_perm(self, site):
-        if not self.is_site_wide:
-            return
-        site_group = Group.objects.get(pk=self.group.pk)
-        permissions = self.group.permissions.all()
-        site_group.pk = None
-        site_group.name = Role.group_name_pattern % {
+    def get_site_group_name(self, site_domain):
+        return Role.group_name_pattern % {
             'role_name': self.name,
-            'site_domain': site.domain}
-        site_group.save()
-        site_group.permissions = permissions
-        kwargs = self._get_permissions_dict()
-        kwargs['group'] = site_group
-        gp = GlobalPagePermission.objects.create(**kwargs)
-        gp.sites.add(site)
-        self.derived_global_permissions.add(gp)
+            'site_domain': site_domain}
+
+    def add_site_specific_global_page_perm(self, site):
+        self.add_site_specific_global_page_perms([site])
+
+    def add_site_specific_global_page_perms(self, sites):
+        """Creates the site specific group and global page permission
+        for each of the given sites"""
+        provision_site_groups((self, site) for site in sites)
 
     def grant_to_user(self, user, site, pages=None):
         """Grant the given user this role for given site"""
+        self.grant_to_users([user], site, pages)
+
+    def grant_to_users(self, users, site, pages=None):
+        """Grant the given users this role for given site. The number of
+        queries doesn't depend on the number of users or pages.
+        """
+        users = list(users)
         if self.is_site_wide:
-            user.groups.add(self.get_site_specific_group(site))
+            site_group_id = self.derived_global_permissions.filter(
+                sites=site).values_list('group', flat=True).get()
+            add_group_memberships(
+                (user.pk, site_group_id) for user in users)
+            _flag_staff_users(users)
+            bump_site_versions([site.pk])
         else:
-            if pages is None or len(pages) == 0:
-                raise ValidationError('At lest a page must be given')
-            # delete the existing page perms
-            self.get_user_page_perms(user, site).delete()
-            # and assign the new ones
-            for page in pages:
-                page_permission = PagePermission(
-                    page=page, user=user,
-                    grant_on=ACCESS_PAGE_AND_DESCENDANTS)
-                for key, value in self._get_permissions_dict()\
-                        .iteritems():
-                    setattr(page_permission, key, value)
-                page_permission.save()
-                self.derived_page_permissions.add(page_permission)
-            user.groups.add(self.group)
-        if not user.is_staff:
-            user.is_staff = True
-            user.save()
+            self.grant_pages_to_users(
+                dict((user, pages) for user in users), site)
+
+    def grant_pages_to_users(self, user_pages, site, keep_existing=False):
+        """For a non site wide role, grants each user from the given user
+        to pages mapping this role on its pages from site. Only the page
+        perms that differ from the requested ones get touched. With
+        keep_existing the pages the users already have are left alone
+        instead of being revoked.
+        """
+        if self.is_site_wide:
+            raise ValueError(
+                'This makes sense only for non site wide roles')
+        if any(pages is None or len(pages) == 0
+               for pages in user_pages.itervalues()):
+            raise ValidationError('At lest a page must be given')
+        user_ids = [user.pk for user in user_pages]
+        requested = set((user.pk, page.pk)
+                        for user, pages in user_pages.iteritems()
+                        for page in pages)
+        current = set()
+        obsolete_perm_pks = []
+        for page_perm_pk, user_page in self._get_users_page_perms(
+                user_ids, site):
+            if user_page in requested and user_page not in current:
+                current.add(user_page)
+            elif not keep_existing:
+                obsolete_perm_pks.append(page_perm_pk)
+        self._delete_derived_page_perms(obsolete_perm_pks)
+        self._create_derived_page_perms(requested - current)
+        add_group_memberships(
+            (user_id, self.group_id) for user_id in user_ids)
+        _flag_staff_users(user_pages.keys())
+        bump_site_versions([site.pk])
+
+    def _get_users_page_perms(self, user_ids, site):
+        """Returns (pk, (user_id, page_id)) pairs for the derived page
+        permissions of the given users on site"""
+        page_perms = []
+        for user_ids_chunk in chunked(user_ids):
+            page_perms.extend(
+                (pk, (user_id, page_id)) for pk, user_id, page_id in
+                self.derived_page_permissions.filter(
+                    page__site=site, user__in=user_ids_chunk)
+                .values_list('pk', 'user', 'page'))
+        return page_perms
 
     def ungrant_from_user(self, user, site):
         """Remove the given user from this role from the given site"""
+        self.ungrant_from_users([user], site)
+
+    def ungrant_from_users(self, users, site):
+        """Remove the given users from this role from the given site"""
         # TODO: Extract some 'state' class that implements the 
         #       is/isn't site wide differences or create two different
         #       Role classes
+        user_ids = [user.pk for user in users]
         if self.is_site_wide:
-            user.groups.remove(self.get_site_specific_group(site))
+            site_group_id = self.derived_global_permissions.filter(
+                sites=site).values_list('group', flat=True).get()
+            remove_group_memberships(user_ids, site_group_id)
         else:
-            for perm in self.derived_page_permissions.filter(page__site=site, user=user):
-                perm.delete()
-            if self.derived_page_permissions.count() == 0:
-                user.groups.remove(self.group)
+            self._delete_derived_page_perms(
+                [pk for pk, user_page in
+                 self._get_users_page_perms(user_ids, site)])
+            # users that still have this role on other sites need to
+            #   remain in the role's group
+            for user_ids_chunk in chunked(user_ids):
+                remaining = set(self.derived_page_permissions.filter(
+                        user__in=user_ids_chunk).order_by().values_list(
+                        'user', flat=True).distinct())
+                remove_group_memberships(
+                    [user_id for user_id in user_ids_chunk
+                     if user_id not in remaining],
+                    self.group_id)
+        bump_site_versions([site.pk])
 
     def all_users(self):
         """Returns all users having this role."""
@@ -259,6 +460,177 @@ class Role(AbstractPagePermission):
         return self.derived_page_permissions.filter(page__site=site, user=user)
 
 
+def update_group_names(new_names):
+    """Renames groups given a group id to new name mapping using one
+    UPDATE statement per MAX_IN_CLAUSE_SIZE // 2 groups"""
+    if not new_names:
+        return
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for group_ids in chunked(new_names, MAX_IN_CLAUSE_SIZE // 2):
+        sql = 'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+            qn(Group._meta.db_table), qn('name'), qn('id'),
+            ' '.join(['WHEN %s THEN %s'] * len(group_ids)),
+            qn('id'), ', '.join(['%s'] * len(group_ids)))
+        params = []
+        for group_id in group_ids:
+            params.extend([group_id, new_names[group_id]])
+        params.extend(group_ids)
+        cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+
+
+def _new_conversion_report():
+    return {'users': 0,
+            'memberships_added': 0,
+            'page_permissions_created': 0,
+            'page_permissions_deleted': 0,
+            'site_groups_deleted': 0,
+            'lost_users': []}
+
+
+def add_group_memberships(user_groups):
+    """Adds users to groups given (user_id, group_id) pairs, skipping
+    the existing memberships. Returns the number of added memberships.
+    """
+    UserGroup = User.groups.through
+    user_groups = set(user_groups)
+    for group_ids in chunked(set(group_id for user_id, group_id in user_groups)):
+        user_groups.difference_update(UserGroup.objects.filter(
+                group__in=group_ids).values_list('user', 'group'))
+    bulk_create(UserGroup, [
+        UserGroup(user_id=user_id, group_id=group_id)
+        for user_id, group_id in user_groups])
+    if user_groups:
+        bump_administered_sites_version()
+    return len(user_groups)
+
+
+def remove_group_memberships(user_ids, group_id):
+    """Removes the given users from a group without sending signals"""
+    removed = 0
+    for user_ids_chunk in chunked(user_ids):
+        removed += delete_in_bulk(User.groups.through.objects.filter(
+                group=group_id, user__in=user_ids_chunk))
+    if removed:
+        clear_permission_cache()
+        bump_administered_sites_version()
+    return removed
+
+
+def flag_staff(user_ids):
+    """Sets is_staff for the given users, which is needed for them
+    to access the admin"""
+    for user_ids_chunk in chunked(user_ids):
+        User.objects.filter(pk__in=user_ids_chunk, is_staff=False)\
+            .update(is_staff=True)
+
+
+def _flag_staff_users(users):
+    flag_staff([user.pk for user in users if not user.is_staff])
+    for user in users:
+        user.is_staff = True
+
+
+def delete_global_page_perms(global_perm_pks):
+    """Deletes the given global page permissions together with their
+    site and derived_global_permissions rows, without sending signals"""
+    for pks in chunked(global_perm_pks):
+        delete_in_bulk(Role.derived_global_permissions.through.objects
+                       .filter(globalpagepermission__in=pks))
+        delete_in_bulk(GlobalPagePermission.sites.through.objects
+                       .filter(globalpagepermission__in=pks))
+        delete_in_bulk(GlobalPagePermission.objects.filter(pk__in=pks))
+    bump_administered_sites_version()
+
+
+def delete_groups(group_ids):
+    """Deletes the given groups, their memberships and permissions and
+    the global and page permissions given to them, without sending
+    signals. Returns the number of deleted groups.
+    """
+    GlobalPermSite = GlobalPagePermission.sites.through
+    RoleGlobalPerm = Role.derived_global_permissions.through
+    RolePagePerm = Role.derived_page_permissions.through
+    deleted = 0
+    for group_ids_chunk in chunked(group_ids):
+        delete_in_bulk(RoleGlobalPerm.objects.filter(
+                globalpagepermission__group__in=group_ids_chunk))
+        delete_in_bulk(GlobalPermSite.objects.filter(
+                globalpagepermission__group__in=group_ids_chunk))
+        delete_in_bulk(GlobalPagePermission.objects.filter(
+                group__in=group_ids_chunk))
+        delete_in_bulk(RolePagePerm.objects.filter(
+                pagepermission__group__in=group_ids_chunk))
+        delete_in_bulk(PagePermission.objects.filter(
+                group__in=group_ids_chunk))
+        delete_in_bulk(User.groups.through.objects.filter(
+                group__in=group_ids_chunk))
+        delete_in_bulk(Group.permissions.through.objects.filter(
+                group__in=group_ids_chunk))
+        deleted += delete_in_bulk(Group.objects.filter(pk__in=group_ids_chunk))
+    if deleted:
+        clear_permission_cache()
+        bump_administered_sites_version()
+    return deleted
+
+
+def provision_site_groups(role_site_pairs):
+    """Creates the auto generated site groups and global page permissions
+    for the given (role, site) pairs. Non site wide roles are skipped.
+
+    Everything is inserted through bulk statements so the number of
+    queries doesn't depend on the number of pairs (except for splitting
+    the lookups in chunks of MAX_IN_CLAUSE_SIZE).
+    """
+    pairs_by_group_name = dict(
+        (role.get_site_group_name(site.domain), (role, site))
+        for role, site in role_site_pairs if role.is_site_wide)
+    if not pairs_by_group_name:
+        return
+    roles = dict((role.pk, role)
+                 for role, site in pairs_by_group_name.itervalues())
+    role_permissions = dict(
+        (role.pk, role._get_permissions_dict()) for role in roles.itervalues())
+    base_group_perms = {}
+    base_group_perms_q = Group.permissions.through.objects.filter(
+        group__in=[role.group_id for role in roles.itervalues()])
+    for group_id, perm_id in base_group_perms_q.values_list(
+            'group_id', 'permission_id'):
+        base_group_perms.setdefault(group_id, []).append(perm_id)
+
+    bulk_create(Group, [Group(name=name) for name in pairs_by_group_name])
+    site_group_ids = {}
+    for names in chunked(pairs_by_group_name):
+        site_group_ids.update(
+            Group.objects.filter(name__in=names).values_list('name', 'id'))
+    bulk_create(Group.permissions.through, [
+        Group.permissions.through(
+            group_id=site_group_ids[name], permission_id=perm_id)
+        for name, (role, site) in pairs_by_group_name.iteritems()
+        for perm_id in base_group_perms.get(role.group_id, [])])
+
+    bulk_create(GlobalPagePermission, [
+        GlobalPagePermission(group_id=site_group_ids[name],
+                             **role_permissions[role.pk])
+        for name, (role, site) in pairs_by_group_name.iteritems()])
+    global_perm_ids = {}
+    for group_ids in chunked(site_group_ids.values()):
+        global_perm_ids.update(
+            GlobalPagePermission.objects.filter(group__in=group_ids)
+            .values_list('group_id', 'id'))
+    bulk_create(GlobalPagePermission.sites.through, [
+        GlobalPagePermission.sites.through(
+            globalpagepermission_id=global_perm_ids[site_group_ids[name]],
+            site_id=site.pk)
+        for name, (role, site) in pairs_by_group_name.iteritems()])
+    bulk_create(Role.derived_global_permissions.through, [
+        Role.derived_global_permissions.through(
+            role_id=role.pk,
+            globalpagepermission_id=global_perm_ids[site_group_ids[name]])
+        for name, (role, site) in pairs_by_group_name.iteritems()])
+
+
 @receiver(signals.pre_delete, sender=Group)
 def delete_role(instance, **kwargs):
     """When group that a role uses gets deleted, that role also
@@ -274,12 +646,143 @@ def delete_role(instance, **kwargs):
         role.delete()
 
 
+def create_sites(sites, chunk_size=100):
+    """Saves the given unsaved Site objects in chunks. The site groups
+    and global page permissions of all site wide roles are provisioned
+    once per chunk instead of once per site.
+    """
+    site_wide_roles = list(Role.objects.filter(is_site_wide=True))
+    created_sites = []
+    for sites_chunk in chunked(sites, chunk_size):
+        with transaction.commit_on_success():
+            for site in sites_chunk:
+                # tells create_role_groups to leave the provisioning to us
+                site._skip_role_groups = True
+                site.save()
+            provision_site_groups(
+                (role, site) for site in sites_chunk
+                for role in site_wide_roles)
+        created_sites.extend(sites_chunk)
+    return created_sites
+
+
+class SiteVersion(models.Model):
+    """Counts the changes of a site's role assignments. Clients and caches
+    can tell whether the assignments changed by only looking at it.
+    """
+
+    class Meta:
+        app_label = 'cmsroles'
+
+    site = models.OneToOneField(Site, primary_key=True,
+                                related_name='cmsroles_version')
+    version = models.PositiveIntegerField(default=1)
+    modified = models.DateTimeField(default=timezone.now)
+
+    def __unicode__(self):
+        return u'%s v%d' % (self.site_id, self.version)
+
+
+def get_site_version(site):
+    """Returns the (version, modified) pair of site's role assignments"""
+    try:
+        return SiteVersion.objects.filter(site=site).values_list(
+            'version', 'modified').get()
+    except SiteVersion.DoesNotExist:
+        site_version, created = SiteVersion.objects.get_or_create(site=site)
+        return site_version.version, site_version.modified
+
+
+def bump_site_versions(site_ids=None):
+    """Marks the role assignments of the given sites, or of all sites
+    when site_ids is None, as changed. Sites whose version was never
+    looked up don't need one yet.
+    """
+    changes = {'version': models.F('version') + 1, 'modified': timezone.now()}
+    if site_ids is None:
+        SiteVersion.objects.update(**changes)
+        return
+    for site_ids_chunk in chunked(site_ids):
+        SiteVersion.objects.filter(site__in=site_ids_chunk).update(**changes)
+
+
+# cache key of the token that the cached administered site ids of all
+#   users are stored under
+ADMINISTERED_SITES_VERSION_KEY = 'cmsroles-administered-sites-version'
+
+
+def get_administered_sites_cache_timeout():
+    return getattr(settings, 'CMSROLES_ADMINISTERED_SITES_CACHE_TIMEOUT', 300)
+
+
+def get_administered_sites_version():
+    """Returns the token under which the administered site ids are
+    currently cached. A missing token, be it expired or evicted, gets
+    replaced by a new one so stale ids are never read back.
+    """
+    version = cache.get(ADMINISTERED_SITES_VERSION_KEY)
+    if version is None:
+        cache.add(ADMINISTERED_SITES_VERSION_KEY, uuid.uuid4().hex,
+                  get_administered_sites_cache_timeout())
+        version = cache.get(ADMINISTERED_SITES_VERSION_KEY)
+    return version
+
+
+def bump_administered_sites_version():
+    """Invalidates the cached administered site ids of all users"""
+    cache.set(ADMINISTERED_SITES_VERSION_KEY, uuid.uuid4().hex,
+              get_administered_sites_cache_timeout())
+
+
+class UserSetupJob(models.Model):
+    """A user setup submission that is too large to be applied while
+    serving the request. The changes are stored as a serialized
+    SiteChangeset and get applied by the run_user_setup_jobs command.
+    """
+
+    class Meta:
+        app_label = 'cmsroles'
+        ordering = ('created',)
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _('pending')),
+        (RUNNING, _('running')),
+        (DONE, _('done')),
+        (FAILED, _('failed')))
+
+    site = models.ForeignKey(Site)
+    created_by = models.ForeignKey(User, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    changes = models.TextField()
+    # number of users that get changed and how many of them are done
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    # refreshed while the job runs so jobs whose worker died can be told
+    #   apart from the ones still running
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return u'%s %s (%d/%d)' % (self.site, self.status,
+                                   self.done, self.total)
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+
 @receiver(signals.post_save, sender=Site)
 def create_role_groups(instance, **kwargs):
     site = instance
-    if kwargs['created']:
-        for role in Role.objects.all():
-            role.add_site_specific_global_page_perm(site)
+    if kwargs['created'] and not getattr(site, '_skip_role_groups', False):
+        provision_site_groups(
+            (role, site) for role in Role.objects.filter(is_site_wide=True))
 
 
 @receiver(signals.pre_save, sender=Site)
@@ -304,6 +807,7 @@ def update_site_group_names(instance, **kwargs):
             role.update_site_groups(
                 update_names=True,
                 update_permissions=False)
+        bump_site_versions([site.pk])
 
 
 @receiver(signals.pre_delete, sender=Site)
@@ -353,3 +857,141 @@ def update_site_specific_groups(instance, **kwargs):
         role.update_site_groups(
             update_names=False,
             update_permissions=True)
+        bump_site_versions(
+            role.derived_global_permissions.filter(sites__isnull=False)
+            .values_list('sites', flat=True))
+
+
+def _get_site_group_site_ids(group_ids):
+    return GlobalPagePermission.objects.filter(
+        group__in=group_ids, sites__isnull=False).values_list(
+        'sites', flat=True)
+
+
+@receiver(signals.pre_delete, sender=Group)
+def bump_deleted_site_group_versions(instance, **kwargs):
+    """Users lose their roles on the sites of deleted site groups"""
+    bump_site_versions(_get_site_group_site_ids([instance.pk]))
+
+
+@receiver(signals.m2m_changed, sender=User.groups.through)
+def bump_membership_site_versions(instance, action, reverse, pk_set,
+                                  **kwargs):
+    """Group memberships that change outside of the role methods, like
+    from the admin, change who has a site wide role on the sites of the
+    affected site groups
+    """
+    if action == 'post_clear':
+        bump_site_versions()
+    elif action in ('post_add', 'post_remove'):
+        group_ids = [instance.pk] if reverse else pk_set
+        bump_site_versions(_get_site_group_site_ids(group_ids))
+
+
+@receiver(signals.post_save, sender=PagePermission)
+@receiver(signals.pre_delete, sender=PagePermission)
+def bump_page_permission_site_version(instance, **kwargs):
+    """Page permissions that change outside of the role methods might
+    be ones derived from page based roles"""
+    if instance.page_id is not None:
+        bump_site_versions(Page.objects.filter(
+                pk=instance.page_id).values_list('site', flat=True))
+
+
+@receiver(signals.m2m_changed, sender=Role.derived_page_permissions.through)
+def bump_derived_page_perm_site_versions(instance, action, reverse, pk_set,
+                                         **kwargs):
+    """Page permissions that become or stop being derived from a role,
+    like the ones manage_page_permissions takes over, change who has
+    that role on the pages' sites"""
+    if action == 'post_clear':
+        bump_site_versions()
+    elif action in ('post_add', 'post_remove'):
+        if reverse:
+            site_ids = Page.objects.filter(
+                pk=instance.page_id).values_list('site', flat=True)
+        else:
+            site_ids = PagePermission.objects.filter(
+                pk__in=pk_set).values_list('page__site', flat=True)
+        bump_site_versions(site_ids)
+
+
+@receiver(signals.m2m_changed, sender=Role.derived_global_permissions.through)
+def bump_derived_global_perm_site_versions(instance, action, reverse,
+                                           pk_set, **kwargs):
+    if action == 'post_clear':
+        bump_site_versions()
+    elif action in ('post_add', 'post_remove'):
+        global_perm_ids = [instance.pk] if reverse else pk_set
+        bump_site_versions(GlobalPagePermission.objects.filter(
+                pk__in=global_perm_ids, sites__isnull=False).values_list(
+                'sites', flat=True))
+
+
+# the user fields that show up in the user setup page
+USER_LABEL_FIELDS = ('username', 'email', 'first_name', 'last_name',
+                     'is_active')
+
+
+@receiver(signals.post_init, sender=User)
+def attach_old_label_attr(instance, **kwargs):
+    """Attach a magic attribute named _old_label that is then used by
+    bump_user_site_versions for telling whether the way the user shows
+    up in the user setup page changed. The label is taken from the
+    values the user got loaded with so saving users, like on every
+    login, doesn't take an extra query.
+    """
+    user = instance
+    if user.pk is not None and all(
+            field in user.__dict__ for field in USER_LABEL_FIELDS):
+        user._old_label = tuple(
+            user.__dict__[field] for field in USER_LABEL_FIELDS)
+
+
+def _get_user_site_ids(user):
+    """Returns the ids of the sites on which user has a role"""
+    site_ids = set(GlobalPagePermission.objects.filter(
+            group__user=user, role__isnull=False).values_list(
+            'sites', flat=True))
+    site_ids.update(PagePermission.objects.filter(
+            user=user, role__isnull=False).values_list(
+            'page__site', flat=True))
+    site_ids.discard(None)
+    return site_ids
+
+
+@receiver(signals.post_save, sender=User)
+def bump_user_site_versions(instance, **kwargs):
+    user = instance
+    old_label = getattr(user, '_old_label', None)
+    new_label = tuple(getattr(user, field) for field in USER_LABEL_FIELDS)
+    user._old_label = new_label
+    if old_label is None or old_label == new_label:
+        return
+    bump_site_versions(_get_user_site_ids(user))
+
+
+@receiver(signals.pre_delete, sender=User)
+def bump_deleted_user_site_versions(instance, **kwargs):
+    """The user's memberships and page permissions get deleted along
+    with it without any m2m_changed signals being sent"""
+    bump_site_versions(_get_user_site_ids(instance))
+
+
+@receiver(signals.post_save, sender=Role)
+@receiver(signals.post_delete, sender=Role)
+@receiver(signals.post_save, sender=GlobalPagePermission)
+@receiver(signals.post_delete, sender=GlobalPagePermission)
+@receiver(signals.post_delete, sender=Site)
+def invalidate_administered_sites(**kwargs):
+    """Any of these changes might give or take away administrative
+    rights on some sites"""
+    bump_administered_sites_version()
+
+
+@receiver(signals.m2m_changed, sender=User.groups.through)
+@receiver(signals.m2m_changed, sender=Group.permissions.through)
+@receiver(signals.m2m_changed, sender=GlobalPagePermission.sites.through)
+def invalidate_administered_sites_m2m(action, **kwargs):
+    if action.startswith('post_'):
+        bump_administered_sites_version()
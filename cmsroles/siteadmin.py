@@ -1,11 +1,84 @@
-from django.contrib.auth.models import Permission
+from django.conf import settings
+from django.contrib.auth.models import Permission, User
 from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db.models import Q, signals
+from django.dispatch import receiver
 
-from cmsroles.models import Role
+from cmsroles.models import Role, get_administered_sites_cache_timeout, \
+    get_administered_sites_version
+from cmsroles.utils import chunked, MAX_IN_CLAUSE_SIZE
+
+import time
+
+
+# natural key of the permission that grants access to user setup
+SITE_ADMIN_PERMISSION_KEY = ('user_setup', 'cmsroles', 'role')
+
+# the permission's pk is looked up once per process
+_site_admin_permission_cache = {}
+
+
+def get_site_admin_required_permission_pk():
+    if 'pk' not in _site_admin_permission_cache:
+        codename, app_label, model = SITE_ADMIN_PERMISSION_KEY
+        _site_admin_permission_cache['pk'] = Permission.objects.filter(
+            codename=codename, content_type__app_label=app_label,
+            content_type__model=model).values_list('pk', flat=True).get()
+    return _site_admin_permission_cache['pk']
 
 
 def get_site_admin_required_permission():
-    return Permission.objects.get(content_type__model='role', codename='user_setup')
+    return Permission.objects.get(pk=get_site_admin_required_permission_pk())
+
+
+@receiver(signals.post_syncdb)
+@receiver(signals.post_delete, sender=Permission)
+def clear_site_admin_permission_cache(**kwargs):
+    """Permissions might get re-created with different pks whenever
+    they are re-synced"""
+    _site_admin_permission_cache.clear()
+
+
+# domain -> site pk mapping, loaded once per process
+_site_pks_by_domain = {}
+
+# when _site_pks_by_domain was last loaded
+_site_domains_loaded = {}
+
+
+def get_site_domains_reload_interval():
+    return getattr(settings, 'CMSROLES_SITE_DOMAINS_RELOAD_INTERVAL', 60)
+
+
+def get_site_pk_by_domain(domain):
+    """Returns the pk of the site having the given domain or None. The
+    domains are looked up once and then again only for unknown domains,
+    which might belong to sites that other processes created. So that
+    unknown hosts don't reload the domains on every request, that
+    happens at most once per CMSROLES_SITE_DOMAINS_RELOAD_INTERVAL
+    seconds. Sites saved or deleted by this process are seen right away.
+    """
+    loaded = _site_domains_loaded.get('time', None)
+    if domain not in _site_pks_by_domain and (
+            loaded is None or
+            time.time() - loaded >= get_site_domains_reload_interval()):
+        site_pks_by_domain = {}
+        for site_domain, site_pk in Site.objects.order_by(
+                '-pk').values_list('domain', 'pk'):
+            # the oldest site wins when domains are shared
+            site_pks_by_domain[site_domain] = site_pk
+        _site_pks_by_domain.clear()
+        _site_pks_by_domain.update(site_pks_by_domain)
+        _site_domains_loaded['time'] = time.time()
+    return _site_pks_by_domain.get(domain, None)
+
+
+@receiver(signals.post_save, sender=Site)
+@receiver(signals.post_delete, sender=Site)
+def clear_site_domain_cache(**kwargs):
+    _site_pks_by_domain.clear()
+    _site_domains_loaded.clear()
 
 
 def is_site_admin(user):
@@ -14,44 +87,126 @@ def is_site_admin(user):
     """
     if user.is_superuser:
         return True
-    req_perm_obj = get_site_admin_required_permission()
-    req_perm = '%s.%s' % (req_perm_obj.content_type.app_label,
-                          req_perm_obj.codename)
-    return user.is_staff and req_perm in user.get_all_permissions()
+    if not user.is_staff:
+        return False
+    perm_pk = get_site_admin_required_permission_pk()
+    return User.objects.filter(
+        Q(user_permissions=perm_pk) | Q(groups__permissions=perm_pk),
+        pk=user.pk).exists()
 
 
 def is_site_admin_group(group):
     """Returns whether group gives site admin rights to the users
     that belong to it.
     """
-    return get_site_admin_required_permission() in group.permissions.all()
+    return group.permissions.filter(
+        pk=get_site_admin_required_permission_pk()).exists()
+
+
+def get_administered_sites_queryset(user):
+    """Returns a lazy queryset of the sites on which user has
+    administrative rights. Evaluating it takes a single query.
+    """
+    if user.is_superuser:
+        return Site.objects.all()
+    perm_pk = get_site_admin_required_permission_pk()
+    return Site.objects.filter(
+        Q(globalpagepermission__group__user=user,
+          globalpagepermission__group__permissions=perm_pk) |
+        Q(globalpagepermission__user=user)).distinct()
 
 
 def get_administered_sites(user):
     """Returns a list of sites on which user has administrative rights"""
+    return list(get_administered_sites_queryset(user))
+
+
+def get_administered_site_ids(user):
+    """Returns a frozenset of the pks of the sites on which user has
+    administrative rights. The pks are cached per user and are dropped
+    whenever roles, group memberships or global page permissions change.
+    """
     if user.is_superuser:
-        return [s for s in Site.objects.all()]
-    sites = []
+        return frozenset(Site.objects.values_list('pk', flat=True))
+    key = 'cmsroles-administered-sites-%s-%d' % (
+        get_administered_sites_version(), user.pk)
+    site_ids = cache.get(key)
+    if site_ids is None:
+        site_ids = frozenset(
+            get_administered_sites_queryset(user).values_list('pk', flat=True))
+        cache.set(key, site_ids, get_administered_sites_cache_timeout())
+    return site_ids
+
 
-    def lookup_sites(auth_obj):
-        for global_perm in auth_obj.globalpagepermission_set.\
-                prefetch_related('sites').all():
-            sites.extend(global_perm.sites.all())
+def get_cached_administered_sites_queryset(user):
+    """Same as get_administered_sites_queryset, but filters the sites by
+    their cached pks instead of joining the permission tables"""
+    if user.is_superuser:
+        return Site.objects.all()
+    site_ids = get_administered_site_ids(user)
+    if len(site_ids) > MAX_IN_CLAUSE_SIZE:
+        return get_administered_sites_queryset(user)
+    return Site.objects.filter(pk__in=site_ids)
 
-    for group in user.groups.all():
-        if is_site_admin_group(group):
-            lookup_sites(group)
-    lookup_sites(user)
 
-    return sites
+def _site_user_role_queries(site):
+    """Returns two Role querysets joining the roles with the users that
+    have them on site: one through the site groups of the site wide roles
+    and one through the derived page permissions of the other roles.
+    The join to the user table is reachable with the returned prefixes.
+    """
+    site_wide_prefix = 'derived_global_permissions__group__user'
+    page_prefix = 'derived_page_permissions__user'
+    site_wide_q = Role.objects.filter(**{
+            'is_site_wide': True,
+            'derived_global_permissions__sites': site,
+            '%s__isnull' % site_wide_prefix: False})
+    page_q = Role.objects.filter(**{
+            'is_site_wide': False,
+            'derived_page_permissions__page__site': site,
+            '%s__isnull' % page_prefix: False})
+    return ((site_wide_q, site_wide_prefix), (page_q, page_prefix))
+
+
+def get_site_user_rows(site):
+    """Returns (user_id, username, email, role_id) tuples for all users
+    that have a role on site. Uses two queries regardless of the number
+    of roles and doesn't build any model instances.
+    """
+    users_to_rows = {}
+    for role_q, prefix in _site_user_role_queries(site):
+        rows = role_q.order_by('pk').values_list(
+            '%s__id' % prefix, '%s__username' % prefix,
+            '%s__email' % prefix, 'pk')
+        for row in rows:
+            users_to_rows[row[0]] = row
+    return users_to_rows.values()
 
 
-def get_site_users(site):
+def get_site_users(site, user_pks=None):
     """Returns a dictionary containing all users mapped to their role
-    that belong to site.
+    that belong to site. When user_pks is given only the users having
+    one of those pks are looked up.
     """
-    users_to_roles = {}
-    for role in Role.objects.all():
-        for user in role.users(site):
-            users_to_roles[user] = role
-    return users_to_roles
+    users_to_role_pks = dict(
+        (user_pk, role_pk)
+        for user_pk, username, email, role_pk in get_site_user_rows(site))
+    if user_pks is not None:
+        users_to_role_pks = dict(
+            (user_pk, users_to_role_pks[user_pk]) for user_pk in user_pks
+            if user_pk in users_to_role_pks)
+    if not users_to_role_pks:
+        return {}
+    roles = Role.objects.in_bulk(set(users_to_role_pks.values()))
+    if user_pks is not None:
+        users = []
+        for pks_chunk in chunked(users_to_role_pks):
+            users.extend(User.objects.filter(pk__in=pks_chunk))
+    else:
+        user_filter = Q()
+        for role_q, prefix in _site_user_role_queries(site):
+            user_filter |= Q(pk__in=role_q.values(prefix))
+        users = User.objects.filter(user_filter)
+    return dict((user, roles[users_to_role_pks[user.pk]])
+                for user in users
+                if user.pk in users_to_role_pks)
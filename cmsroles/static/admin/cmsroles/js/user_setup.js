@@ -8,10 +8,71 @@ django.jQuery(document).ready(function(){
         deleteText: '',
         added: function(row){
             $('select', row).chosen(default_chosen_settings);
+            init_user_search($('select[name$="user"]', row));
             $('.assign-pages', row).hide();
         },
     });
 
+    // user select boxes only come with the selected user, the other
+    // users are searched for on the server while typing and further
+    // pages of matches get loaded when scrolling to the end of the list
+    function init_user_search(user_select){
+        var container = user_select.next('.chosen-container');
+        var search_field = container.find('.chosen-search input');
+        var timeout = null;
+        var term = '';
+        var page = 1;
+        var more = false;
+        var loading = false;
+
+        function load_users(){
+            loading = true;
+            $.getJSON('/admin/cmsroles/search_users/', {q: term, page: page},
+                      function(data){
+                var selected = user_select.val();
+                if (page === 1){
+                    $('option', user_select).each(function(){
+                        var option = $(this);
+                        if (option.val() !== '' && option.val() !== selected){
+                            option.remove();
+                        }
+                    });
+                }
+                $.each(data.results, function(i, user){
+                    if (String(user.id) !== selected){
+                        user_select.append($('<option/>')
+                            .val(user.id).text(user.text));
+                    }
+                });
+                more = data.more;
+                loading = false;
+                user_select.trigger('chosen:updated');
+                search_field.val(term);
+            });
+        }
+
+        search_field.bind('keyup', function(e){
+            var new_term = $(this).val();
+            if (new_term === term){
+                return;
+            }
+            term = new_term;
+            clearTimeout(timeout);
+            timeout = setTimeout(function(){
+                page = 1;
+                load_users();
+            }, 300);
+        });
+        container.find('.chosen-results').bind('scroll', function(){
+            var results = $(this);
+            if (more && !loading && results.scrollTop() +
+                    results.innerHeight() >= this.scrollHeight - 10){
+                page += 1;
+                load_users();
+            }
+        });
+    }
+
     function init_page_formset(user_settings){
         var user_role_pair = get_user_and_role(user_settings);
         var prefix = 'user-' + user_role_pair.user.val();
@@ -49,8 +110,38 @@ django.jQuery(document).ready(function(){
         submit_userformset('continue');
     });
 
+    $('#preview').click(function(){
+        submit_userformset('preview');
+    });
+
     $('select').chosen(default_chosen_settings);
 
+    $('.user_settings select[name$="user"]').each(function(){
+        init_user_search($(this));
+    });
+
+    function poll_job(job_pk){
+        $.getJSON('/admin/cmsroles/user_setup_job/', {job: job_pk},
+                  function(data){
+            $('#job_status').html(data.status);
+            $('#job_done').html(data.done);
+            if (data.error){
+                $('#job_error').html(data.error).show();
+            }
+            if (!data.finished){
+                setTimeout(function(){ poll_job(job_pk); }, 2000);
+            } else if (!data.error){
+                // the rendered assignments are outdated by now
+                window.location = '/admin/cmsroles/usersetup/?site=' +
+                    $('#site_selector').val();
+            }
+        });
+    }
+
+    if ($('#job_progress').length){
+        poll_job($('#job_progress').attr('data-job'));
+    }
+
     function get_user_and_role(user_settings_div){
         return {
             user: $('select[name$="user"]', user_settings_div),
@@ -58,21 +149,6 @@ django.jQuery(document).ready(function(){
         }
     }
 
-    $('#search_box').bind('keyup input', function(){
-        var search_word = $(this).val();
-        search_word = search_word.toLowerCase();
-        $.each( $('.user_settings'), function(i, val){
-            var self = $(this);
-            var user = $('span', self).first().html();
-            user = user.toLowerCase();
-            if (user.indexOf(search_word) === -1){
-                self.hide();
-            } else {
-                self.show();
-            }
-        });
-    });
-
     $('.assign-pages').each(function(){
         var user_settings = $(this).parent('.user_settings');
         var role = $('select[name$="role"]', user_settings).val();
@@ -112,6 +188,46 @@ django.jQuery(document).ready(function(){
         });
     }
 
+    // fetches the page formsets of all users whose pages weren't
+    // assigned yet with a single request
+    $('#assign_all_pages').click(function(e){
+        e.preventDefault();
+        var params = {site: $('#site_selector').val(), user: [], role: []};
+        var users_settings = {};
+        $('.assign-pages:visible').each(function(){
+            var user_settings = $(this).parent('.user_settings');
+            var user_role_pair = get_user_and_role(user_settings);
+            params.user.push(user_role_pair.user.val());
+            params.role.push(user_role_pair.role.val());
+            users_settings[user_role_pair.user.val()] = user_settings;
+        });
+        if (params.user.length === 0){
+            return;
+        }
+        $.ajax({
+            type: 'GET',
+            url: '/admin/cmsroles/get_page_formsets/',
+            data: params,
+            traditional: true,
+            success: function(data, textStatus){
+                $.each(data.page_formsets, function(user_pk, page_formset){
+                    var user_settings = users_settings[user_pk];
+                    $('.assign-pages', user_settings).hide();
+                    user_settings.append(page_formset);
+                    init_page_formset(user_settings);
+                    $('.page_form select', user_settings).chosen(
+                        default_chosen_settings);
+                });
+                $.each(data.errors, function(user_pk, error_msg){
+                    alert(error_msg);
+                });
+            },
+            error: function(data, textStatus){
+                alert('Unexpected error!');
+            }
+        });
+    });
+
     $('.assign-pages').click(function(e){
         e.preventDefault();
         var assign_pages_link = $(this);
@@ -133,6 +249,60 @@ django.jQuery(document).ready(function(){
         });
     });
 
+    // page select boxes only come with the selected page, the other
+    // pages are picked from a tree whose nodes get loaded on demand
+    function fetch_page_nodes(parent_item, container){
+        $.getJSON('/admin/cmsroles/get_page_tree/', {
+            site: $('#site_selector').val(),
+            parent: parent_item ? parent_item.attr('data-page') : ''
+        }, function(data){
+            var nodes = $('<ul class="page_tree"/>');
+            $.each(data.nodes, function(i, node){
+                var item = $('<li/>').attr('data-page', node.id);
+                if (node.has_children){
+                    item.append($('<a href="#" class="expand-page">+</a>'));
+                }
+                item.append($('<a href="#" class="pick-page"/>').text(node.text));
+                nodes.append(item);
+            });
+            container.append(nodes);
+        });
+    }
+
+    $('.browse-pages').live('click', function(e){
+        e.preventDefault();
+        var picker = $(this).siblings('.page_picker');
+        if (picker.children().length === 0){
+            fetch_page_nodes(null, picker);
+        }
+        picker.toggle();
+    });
+
+    $('.expand-page').live('click', function(e){
+        e.preventDefault();
+        var item = $(this).parent('li');
+        var children = item.children('.page_tree');
+        if (children.length === 0){
+            fetch_page_nodes(item, item);
+            $(this).html('-');
+        } else {
+            children.toggle();
+            $(this).html(children.is(':visible') ? '-' : '+');
+        }
+    });
+
+    $('.pick-page').live('click', function(e){
+        e.preventDefault();
+        var page_form = $(this).parents('.page_form');
+        var page_select = $('select[name$="page"]', page_form);
+        var page_pk = $(this).parent('li').attr('data-page');
+        if ($('option[value="' + page_pk + '"]', page_select).length === 0){
+            page_select.append($('<option/>').val(page_pk).text($(this).text()));
+        }
+        page_select.val(page_pk).trigger('chosen:updated');
+        $('.page_picker', page_form).hide();
+    });
+
     function remove_page_formset(user_settings){
         var page_formset = $('.page_formset', user_settings);
         if (page_formset.length > 0){
@@ -1,21 +1,61 @@
+import csv
+import datetime
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+from django.db.models import signals
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.contrib import admin
 from django.contrib.auth.models import User, Group, Permission
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
-from django.utils import simplejson
+from django.utils import simplejson, timezone
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.forms.formsets import formset_factory
 
 from cms.models.permissionmodels import GlobalPagePermission, PagePermission
 from cms.models.pagemodel import Page
 from cms.api import create_page
 
-from cmsroles.models import Role
+from cmsroles.admin import UserSetup, UserSetupAdmin
+from cmsroles.changeset import SiteChangeset, run_user_setup_job
+from cmsroles.models import Role, UserSetupJob, create_sites, get_site_version
+from cmsroles.views import BasePageFormSet, _get_page_form_class
 from cmsroles.siteadmin import (is_site_admin, get_administered_sites, get_site_users,
-                                get_site_admin_required_permission)
+                                get_site_user_rows, get_site_admin_required_permission,
+                                get_administered_sites_queryset, get_site_pk_by_domain,
+                                get_administered_site_ids,
+                                get_site_admin_required_permission_pk)
 import cmsroles.management.commands.manage_page_permissions as manage_page_permissions
+import cmsroles.management.commands.convert_role as convert_role
+import cmsroles.management.commands.export_role_assignments as export_role_assignments
+import cmsroles.management.commands.import_role_assignments as import_role_assignments
 
 
 class HelpersMixin(object):
+    def _count_queries(self, func, *args, **kwargs):
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        starting_queries = len(connection.queries)
+        try:
+            func(*args, **kwargs)
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        return len(connection.queries) - starting_queries
+
+    def _count_request_queries(self, func, *args, **kwargs):
+        # the queries log gets reset whenever a request starts
+        request_started.disconnect(reset_queries)
+        try:
+            return self._count_queries(func, *args, **kwargs)
+        finally:
+            request_started.connect(reset_queries)
+
     def _create_site_admin_group(self):
         site_admin_group = Group.objects.create(name='site_admin')
         site_admin_group.permissions.add(get_site_admin_required_permission())
@@ -73,7 +113,7 @@ class HelpersMixin(object):
         writer_role.grant_to_user(bob, bar_site, [master_bar])
 
     def _create_site_with_page(self, domain):
-        site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        site = Site.objects.create(name=domain, domain=domain)
         create_page('master', 'cms_mock_template.html', language='en', site=site)
         return site
 
@@ -92,6 +132,49 @@ class SiteAdminTests(TestCase, HelpersMixin):
         joe = User.objects.get(username='joe')
         self.assertTrue(is_site_admin(joe))
 
+    def test_is_admin_single_query(self):
+        self._create_simple_setup()
+        joe = User.objects.get(username='joe')
+        george = User.objects.get(username='george')
+        # the first call looks up the user_setup permission
+        is_site_admin(joe)
+        self.assertEqual(self._count_queries(is_site_admin, joe), 1)
+        self.assertFalse(is_site_admin(george))
+        george.user_permissions.add(get_site_admin_required_permission())
+        self.assertTrue(is_site_admin(george))
+
+    def test_site_admin_permission_cache_cleared_on_syncdb(self):
+        get_site_admin_required_permission_pk()
+        signals.post_syncdb.send(sender=None, app=None, created_models=[],
+                                 verbosity=0, interactive=False)
+        self.assertEqual(
+            self._count_queries(get_site_admin_required_permission_pk), 1)
+
+    def test_site_pk_by_domain_cached(self):
+        foo_site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        self.assertEqual(get_site_pk_by_domain('foo.site.com'), foo_site.pk)
+        self.assertEqual(
+            self._count_queries(get_site_pk_by_domain, 'foo.site.com'), 0)
+        foo_site.domain = 'bar.site.com'
+        foo_site.save()
+        self.assertEqual(get_site_pk_by_domain('foo.site.com'), None)
+        self.assertEqual(get_site_pk_by_domain('bar.site.com'), foo_site.pk)
+        foo_site.delete()
+        self.assertEqual(get_site_pk_by_domain('bar.site.com'), None)
+
+    def test_unknown_domains_dont_reload_site_domains(self):
+        Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        get_site_pk_by_domain('evil.example')
+        for i in range(5):
+            self.assertEqual(
+                self._count_queries(get_site_pk_by_domain, 'evil.example'), 0)
+        # sites created by other processes don't send signals to this one
+        Site.objects.bulk_create([Site(name='bar.site.com', domain='bar.site.com')])
+        self.assertEqual(get_site_pk_by_domain('bar.site.com'), None)
+        with override_settings(CMSROLES_SITE_DOMAINS_RELOAD_INTERVAL=0):
+            self.assertEqual(get_site_pk_by_domain('bar.site.com'),
+                             Site.objects.get(domain='bar.site.com').pk)
+
     def test_get_administered_sites(self):
         self._create_simple_setup()
         joe = User.objects.get(username='joe')
@@ -105,6 +188,57 @@ class SiteAdminTests(TestCase, HelpersMixin):
             [s.domain for s in administered_sites],
             ['bar.site.com'])
 
+    def test_get_administered_sites_single_query(self):
+        self._create_simple_setup()
+        joe = User.objects.get(username='joe')
+        self.assertEqual(
+            self._count_queries(get_administered_sites, joe), 1)
+        root = User.objects.create_superuser(
+            username='root', password='root', email='root@roto.com')
+        # superusers get a lazy queryset over all sites
+        self.assertEqual(
+            self._count_queries(get_administered_sites_queryset, root), 0)
+        self.assertItemsEqual(get_administered_sites_queryset(root),
+                              Site.objects.all())
+
+    def test_user_setup_admin_change_permission_for_superusers(self):
+        root = User.objects.create_superuser(
+            username='root', password='root', email='root@roto.com')
+        request = type('Request', (object, ), {'user': root})()
+        has_change_permission = UserSetupAdmin(
+            UserSetup, admin.site).has_change_permission
+        self._create_simple_setup()
+        # a single EXISTS query, no matter how many sites there are
+        self.assertEqual(
+            self._count_queries(has_change_permission, request), 1)
+        self.assertTrue(has_change_permission(request))
+
+    def test_administered_site_ids_cached_until_assignments_change(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        bar_site = Site.objects.get(domain='bar.site.com')
+        joe = User.objects.get(username='joe')
+        self.assertEqual(get_administered_site_ids(joe),
+                         set([foo_site.pk, bar_site.pk]))
+        self.assertEqual(
+            self._count_queries(get_administered_site_ids, joe), 0)
+        admin_role = Role.objects.get(name='site admin')
+        admin_role.ungrant_from_user(joe, foo_site)
+        self.assertEqual(get_administered_site_ids(joe), set([bar_site.pk]))
+        # membership changes made outside of the role methods
+        joe.groups.remove(admin_role.get_site_specific_group(bar_site))
+        self.assertEqual(get_administered_site_ids(joe), set())
+        george = User.objects.get(username='george')
+        self.assertEqual(get_administered_site_ids(george), set())
+        developer_role = Role.objects.get(name='developer')
+        developer_role.group.permissions.add(
+            get_site_admin_required_permission())
+        self.assertEqual(get_administered_site_ids(george),
+                         set([foo_site.pk]))
+        GlobalPagePermission.objects.filter(
+            group__user=george, sites=foo_site).delete()
+        self.assertEqual(get_administered_site_ids(george), set())
+
     def test_get_administered_sites_with_user_referencing_glob_page_(self):
         foo_site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
         admin_user = User.objects.create(username='gigi', password='baston')
@@ -119,6 +253,37 @@ class SiteAdminTests(TestCase, HelpersMixin):
             [s.pk for s in administered_sites],
             [foo_site.pk])
 
+    def test_get_site_users(self):
+        self._create_simple_setup()
+        for site in Site.objects.all():
+            expected = {}
+            for role in Role.objects.all():
+                for user in role.users(site):
+                    expected[user.username] = role.name
+            self.assertEqual(
+                dict((u.username, r.name)
+                     for u, r in get_site_users(site).iteritems()),
+                expected)
+            self.assertItemsEqual(
+                [(username, Role.objects.get(pk=role_pk).name)
+                 for user_pk, username, email, role_pk
+                 in get_site_user_rows(site)],
+                expected.items())
+
+    def test_get_site_users_query_count_independent_of_roles(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        few_roles_count = self._count_queries(get_site_users, bar_site)
+        for name in ['designer', 'manager', 'reviewer']:
+            role = Role.objects.create(
+                name=name, group=Group.objects.create(name=name),
+                is_site_wide=True)
+            role.grant_to_user(
+                User.objects.create(username=name, is_staff=True), bar_site)
+        self.assertEqual(few_roles_count,
+                         self._count_queries(get_site_users, bar_site))
+        self.assertEqual(len(get_site_users(bar_site)), 9)
+
     def test_not_accessible_for_non_siteadmins(self):
         joe = User.objects.create_user(
             username='joe', password='x', email='joe@mata.com')
@@ -167,6 +332,88 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
             self.assertEqual(set(site_specific_group.permissions.all()),
                              set(site_admin_group.permissions.all()))
 
+    def test_role_creation_query_count_independent_of_sites(self):
+        def create_role(name, site_count):
+            for i in range(site_count):
+                domain = '%s%d.site.com' % (name, i)
+                Site.objects.create(name=domain, domain=domain)
+            group = Group.objects.create(name=name)
+            group.permissions = Permission.objects.filter(
+                content_type__model='page')
+            return self._count_queries(
+                Role.objects.create, name=name, group=group,
+                is_site_wide=True)
+
+        self.assertEqual(create_role('few', 2), create_role('many', 10))
+        many_role = Role.objects.get(name='many')
+        for site in Site.objects.all():
+            site_group = many_role.get_site_specific_group(site)
+            self.assertEqual(site_group.name, many_role.get_site_group_name(site.domain))
+            self.assertItemsEqual(
+                site_group.permissions.values_list('id', flat=True),
+                many_role.group.permissions.values_list('id', flat=True))
+
+    def test_role_creation_on_more_sites_than_a_batch(self):
+        create_sites([Site(name='site%d.com' % i, domain='site%d.com' % i)
+                      for i in range(700)])
+        group = Group.objects.create(name='editor')
+        group.permissions = Permission.objects.filter(
+            content_type__model='page')
+        editor = Role.objects.create(name='editor', group=group,
+                                     is_site_wide=True)
+        self.assertEqual(editor.derived_global_permissions.count(),
+                         Site.objects.count())
+
+    def test_site_creation_query_count_independent_of_roles(self):
+        def create_roles(names):
+            for name in names:
+                Role.objects.create(
+                    name=name, group=Group.objects.create(name=name),
+                    is_site_wide=True)
+
+        def create_site(domain):
+            return self._count_queries(
+                Site.objects.create, name=domain, domain=domain)
+
+        create_roles(['editor'])
+        few_roles_count = create_site('foo.site.com')
+        create_roles(['writer', 'developer', 'designer'])
+        many_roles_count = create_site('bar.site.com')
+        self.assertEqual(few_roles_count, many_roles_count)
+        bar_site = Site.objects.get(domain='bar.site.com')
+        for role in Role.objects.all():
+            self.assertEqual(role.get_site_specific_group(bar_site).name,
+                             role.get_site_group_name(bar_site.domain))
+
+    def test_create_sites(self):
+        editor = Role.objects.create(
+            name='editor', group=Group.objects.create(name='editor'),
+            is_site_wide=True)
+        writer = Role.objects.create(
+            name='writer', group=Group.objects.create(name='writer'),
+            is_site_wide=False)
+        domains = ['site%d.com' % i for i in range(5)]
+        sites = create_sites(
+            [Site(name=domain, domain=domain) for domain in domains],
+            chunk_size=2)
+        self.assertItemsEqual([site.domain for site in sites], domains)
+        for site in sites:
+            self.assertIsNotNone(site.pk)
+            self.assertEqual(editor.get_site_specific_group(site).name,
+                             editor.get_site_group_name(site.domain))
+        self.assertFalse(writer.derived_global_permissions.exists())
+
+    def test_create_sites_with_many_roles(self):
+        roles = [Role.objects.create(
+                name='role%d' % i, group=Group.objects.create(name='role%d' % i),
+                is_site_wide=True) for i in range(6)]
+        # a default chunk of sites takes more groups than a single insert
+        create_sites([Site(name='site%d.com' % i, domain='site%d.com' % i)
+                      for i in range(100)])
+        for role in roles:
+            self.assertEqual(role.derived_global_permissions.count(),
+                             Site.objects.count())
+
     def test_assign_user_to_non_site_wide_role(self):
         writer_role = self._create_non_site_wide_role()
         foo_site = self._create_site_with_page('foo.site.com')
@@ -181,6 +428,31 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         users = writer_role.users(foo_site)
         self.assertItemsEqual([u.pk for u in users], [user.pk])
 
+    def test_grant_to_users_query_count_independent_of_users(self):
+        def grant(role, user_count, pages=None):
+            users = [User.objects.create(username='%s%d' % (role.name, i))
+                     for i in range(user_count)]
+            queries = self._count_queries(role.grant_to_users, users, foo_site, pages)
+            self.assertTrue(all(user.is_staff for user in users))
+            self.assertItemsEqual([u.pk for u in role.users(foo_site)],
+                                  [u.pk for u in users])
+            return queries
+
+        foo_site = self._create_site_with_page('foo.site.com')
+        master_page = Page.objects.get(title_set__title='master', site=foo_site)
+        self.assertEqual(
+            grant(Role.objects.create(name='few', group=Group.objects.create(name='few')), 1),
+            grant(Role.objects.create(name='many', group=Group.objects.create(name='many')), 5))
+        writer_role = self._create_non_site_wide_role()
+        reviewer_role = Role.objects.create(
+            name='reviewer', group=Group.objects.create(name='reviewer'),
+            is_site_wide=False)
+        self.assertEqual(grant(writer_role, 1, [master_page]),
+                         grant(reviewer_role, 5, [master_page]))
+        self.assertEqual(reviewer_role.derived_page_permissions.count(), 5)
+        self.assertEqual(
+            reviewer_role.group.user_set.filter(is_staff=True).count(), 5)
+
     def test_switch_role_form_non_wide_to_site_wide(self):
         writer_role = self._create_non_site_wide_role()
         foo_site = self._create_site_with_page('foo.site.com')
@@ -215,6 +487,61 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         self.assertItemsEqual([u.pk for u in users], [user.pk])
         self.assertTrue(admin_role.derived_page_permissions.filter(user=user).exists())
 
+    def test_switch_role_query_count_independent_of_users(self):
+        def switch_role(role, user_count):
+            for i in range(user_count):
+                user = User.objects.create(username='%s%d' % (role.name, i))
+                role.grant_to_user(user, foo_site)
+            role.is_site_wide = False
+            page_based_count = self._count_queries(role.save)
+            role.is_site_wide = True
+            return page_based_count, self._count_queries(role.save)
+
+        foo_site = self._create_site_with_page('foo.site.com')
+        few_users_role = Role.objects.create(
+            name='few', group=Group.objects.create(name='few'))
+        many_users_role = Role.objects.create(
+            name='many', group=Group.objects.create(name='many'))
+        self.assertEqual(switch_role(few_users_role, 1),
+                         switch_role(many_users_role, 5))
+        self.assertEqual(len(many_users_role.users(foo_site)), 5)
+        self.assertEqual(many_users_role.conversion_report['users'], 5)
+        self.assertEqual(
+            many_users_role.conversion_report['page_permissions_deleted'], 5)
+        self.assertTrue(all(u.is_staff for u in many_users_role.users(foo_site)))
+
+    def test_switch_role_to_page_based_on_site_without_pages(self):
+        base_site_admin_group = self._create_site_admin_group()
+        admin_role = Role.objects.create(
+            name='site admin', group=base_site_admin_group,
+            is_site_wide=True)
+        foo_site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        user = User.objects.create(username='gigi', is_staff=True)
+        admin_role.grant_to_user(user, foo_site)
+        admin_role.is_site_wide = False
+        admin_role.save()
+        self.assertEqual(admin_role.conversion_report['lost_users'],
+                         [(user.pk, foo_site.pk)])
+        self.assertFalse(admin_role.derived_global_permissions.exists())
+        self.assertEqual(Group.objects.count(), 1)
+
+    def test_convert_role_command(self):
+        writer_role = self._create_non_site_wide_role()
+        foo_site = self._create_site_with_page('foo.site.com')
+        user = User.objects.create(username='gigi', is_staff=True)
+        master_page = Page.objects.get(title_set__title='master', site=foo_site)
+        writer_role.grant_to_user(user, foo_site, [master_page])
+        command = convert_role.Command()
+        output = StringIO()
+        command.execute(role='writer', is_site_wide=True, stdout=output)
+        writer_role = Role.objects.get(pk=writer_role.pk)
+        self.assertTrue(writer_role.is_site_wide)
+        self.assertEqual(command.report['memberships_added'], 1)
+        self.assertIn(u'memberships_added: 1\n', output.getvalue())
+        self.assertItemsEqual([u.pk for u in writer_role.users(foo_site)], [user.pk])
+        with self.assertRaises(CommandError):
+            command.handle(role='writer', is_site_wide=True)
+
     def test_cant_create_two_roles_based_on_the_same_group(self):
         site_admin_group = self._create_site_admin_group()
         Role.objects.create(
@@ -245,6 +572,28 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         # created for each site also got deleted
         self.assertEqual(after_deletion_group_count, group_count - site_count)
 
+    def test_role_deletion_query_count_independent_of_sites(self):
+        def delete_role(name):
+            role = Role.objects.create(
+                name=name, group=Group.objects.create(name=name))
+            return self._count_queries(role.delete)
+
+        few_sites_count = delete_role('few')
+        for i in range(5):
+            domain = 'site%d.com' % i
+            Site.objects.create(name=domain, domain=domain)
+        self.assertEqual(few_sites_count, delete_role('many'))
+        self.assertEqual(Group.objects.count(), 2)
+        self.assertFalse(GlobalPagePermission.objects.exists())
+        self.assertFalse(Role.derived_global_permissions.through.objects.exists())
+
+    def test_non_site_wide_role_deletion(self):
+        self._create_simple_setup()
+        writer_role = Role.objects.get(name='writer')
+        self.assertTrue(writer_role.derived_page_permissions.exists())
+        writer_role.delete()
+        self.assertFalse(PagePermission.objects.exists())
+
     def _setup_site_deletion(self, site_name):
         site = Site.objects.create(name=site_name, domain=site_name)
         base_site_admin_group = self._create_site_admin_group()
@@ -328,6 +677,46 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
                 'role_name': admin_role.name,
                 'site_domain': foo_site.domain})
 
+    def test_role_rename_query_count_independent_of_sites(self):
+        def rename_role(role, new_name):
+            role = Role.objects.get(pk=role.pk)
+            role.name = new_name
+            return self._count_queries(role.save)
+
+        base_site_admin_group = self._create_site_admin_group()
+        admin_role = Role.objects.create(name='site admin', group=base_site_admin_group,
+                                         is_site_wide=True)
+        few_sites_count = rename_role(admin_role, 'admin')
+        for i in range(5):
+            domain = 'site%d.com' % i
+            Site.objects.create(name=domain, domain=domain)
+        self.assertEqual(few_sites_count, rename_role(admin_role, 'new admin'))
+        for site in Site.objects.all():
+            self.assertEqual(
+                admin_role.get_site_specific_group(site).name,
+                Role.group_name_pattern % {'role_name': 'new admin',
+                                           'site_domain': site.domain})
+
+    def test_site_group_perms_synced_with_diff(self):
+        Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        g1 = Group.objects.create(name='g1')
+        page_perms = list(Permission.objects.filter(content_type__model='page'))
+        g1.permissions = page_perms[:2]
+        role = Role.objects.create(name='editor', group=g1)
+        site_group_perms = Group.permissions.through.objects.filter(
+            group__globalpagepermission__role=role)
+        kept_perm_ids = set(site_group_perms.filter(
+                permission=page_perms[1]).values_list('id', flat=True))
+        g1.permissions.remove(page_perms[0])
+        g1.permissions.add(page_perms[2])
+        for site_group in Group.objects.filter(globalpagepermission__role=role):
+            self.assertItemsEqual(site_group.permissions.all(), page_perms[1:3])
+        # rows for permissions that didn't change were left untouched
+        self.assertEqual(
+            set(site_group_perms.filter(
+                    permission=page_perms[1]).values_list('id', flat=True)),
+            kept_perm_ids)
+
     def test_site_group_perms_change_on_role_group_change(self):
         foo_site = Site.objects.create(
             name='foo.site.com', domain='foo.site.com')
@@ -376,6 +765,36 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         for page_perm in writer_role.derived_page_permissions.all():
             self.assertTrue(page_perm.can_add)
 
+    def test_page_perm_changes_propagated_in_a_single_query(self):
+        def toggle_can_add(role, pages):
+            user = User.objects.create(
+                username='user%d' % len(pages), is_staff=True)
+            role.grant_to_user(user, site, pages)
+            role = Role.objects.get(pk=role.pk)
+            role.can_add = not role.can_add
+            return self._count_queries(role.save)
+
+        site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        master = self._create_pages(site)
+        writer_role = self._create_non_site_wide_role()
+        self.assertEqual(toggle_can_add(writer_role, [master]),
+                         toggle_can_add(writer_role, list(Page.objects.all())))
+        writer_role = Role.objects.get(pk=writer_role.pk)
+        for page_perm in writer_role.derived_page_permissions.all():
+            self.assertEqual(page_perm.can_add, writer_role.can_add)
+
+    def test_no_propagation_without_perm_changes(self):
+        self._create_simple_setup()
+        developer_role = Role.objects.get(name='developer')
+        developer_role.derived_global_permissions.update(can_add=False)
+        developer_role.can_add = True
+        developer_role.is_site_wide = True
+        developer_role.save()
+        # can_add didn't change since the role got loaded so the
+        #   derived permissions must've been left untouched
+        self.assertFalse(developer_role.derived_global_permissions.filter(
+                can_add=True).exists())
+
     def test_changes_in_base_group_reflected_in_generated_ones(self):
 
         def check_permissions(role, permission_set):
@@ -439,6 +858,94 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         # but is still assigned to bar
         self.assertItemsEqual([u.pk for u in users], [user.pk])
 
+    def test_regrant_keeps_unchanged_page_perms(self):
+        foo_site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        master = self._create_pages(foo_site)
+        news = Page.objects.get(title_set__title='news', site=foo_site)
+        blog = Page.objects.get(title_set__title='blog', site=foo_site)
+        writer_role = self._create_non_site_wide_role()
+        user = User.objects.create(username='gigi', is_staff=True)
+        writer_role.grant_to_user(user, foo_site, [master, news])
+        master_perm = writer_role.derived_page_permissions.get(page=master)
+        writer_role.grant_to_user(user, foo_site, [master, blog])
+        self.assertItemsEqual(
+            [perm.page for perm in writer_role.get_user_page_perms(user, foo_site)],
+            [master, blog])
+        self.assertEqual(
+            writer_role.derived_page_permissions.get(page=master).pk,
+            master_perm.pk)
+
+    def test_ungrant_from_users(self):
+        foo_site = self._create_site_with_page('foo.site.com')
+        bar_site = self._create_site_with_page('bar.site.com')
+        writer_role = self._create_non_site_wide_role()
+        master_foo = Page.objects.get(title_set__title='master', site=foo_site)
+        master_bar = Page.objects.get(title_set__title='master', site=bar_site)
+        users = [User.objects.create(username='user%d' % i) for i in range(4)]
+        writer_role.grant_to_users(users, foo_site, [master_foo])
+        writer_role.grant_to_users(users[:2], bar_site, [master_bar])
+
+        writer_role.ungrant_from_users(users, foo_site)
+        self.assertEqual(writer_role.users(foo_site), [])
+        self.assertItemsEqual([u.pk for u in writer_role.users(bar_site)],
+                              [u.pk for u in users[:2]])
+        # only the users that have the role on no other site
+        #   got removed from the role's group
+        self.assertItemsEqual(writer_role.group.user_set.all(), users[:2])
+
+    def test_ungrant_from_users_site_wide(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        editor_role = Role.objects.get(name='editor')
+        editors = editor_role.users(bar_site)
+        self.assertEqual(len(editors), 2)
+        editor_role.ungrant_from_users(editors, bar_site)
+        self.assertEqual(editor_role.users(bar_site), [])
+
+    def test_site_versions_bumped_on_assignment_changes(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        bar_site = Site.objects.get(domain='bar.site.com')
+        editor = Role.objects.get(name='editor')
+        criss = User.objects.get(username='criss')
+        foo_version, foo_modified = get_site_version(foo_site)
+        bar_version, bar_modified = get_site_version(bar_site)
+        editor.grant_to_user(criss, foo_site)
+        self.assertEqual(get_site_version(foo_site)[0], foo_version + 1)
+        self.assertEqual(get_site_version(bar_site)[0], bar_version)
+        editor.name = 'reviewer'
+        editor.save()
+        self.assertEqual(get_site_version(foo_site)[0], foo_version + 2)
+        self.assertEqual(get_site_version(bar_site)[0], bar_version + 1)
+
+    def test_site_versions_bumped_on_site_group_membership_changes(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        criss = User.objects.get(username='criss')
+        site_group = Role.objects.get(name='editor').get_site_specific_group(foo_site)
+        version = get_site_version(foo_site)[0]
+        criss.groups.add(site_group)
+        self.assertEqual(get_site_version(foo_site)[0], version + 1)
+        site_group.user_set.remove(criss)
+        self.assertEqual(get_site_version(foo_site)[0], version + 2)
+
+    def test_site_versions_bumped_on_derived_global_perm_changes(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        editor = Role.objects.get(name='editor')
+        global_perm = editor.derived_global_permissions.get(sites=foo_site)
+        version = get_site_version(foo_site)[0]
+        editor.derived_global_permissions.remove(global_perm)
+        self.assertEqual(get_site_version(foo_site)[0], version + 1)
+        global_perm.role_set.add(editor)
+        self.assertEqual(get_site_version(foo_site)[0], version + 2)
+
+    def test_user_save_takes_no_extra_query(self):
+        joe = User.objects.get(pk=User.objects.create(username='joe').pk)
+        joe.last_login = joe.date_joined
+        # Model.save's own SELECT and UPDATE
+        self.assertEqual(self._count_queries(joe.save), 2)
+
     def test_user_belonging_to_more_sites(self):
         """This tests proper functioning of the unassignment
         of a role in the scenario:
@@ -467,6 +974,166 @@ class ObjectInteractionsTests(TestCase, HelpersMixin):
         self.assertIn(bob, writer_users)
 
 
+class SiteChangesetTests(TestCase, HelpersMixin):
+
+    def test_plan_and_apply(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        master_bar = Page.objects.get(title_set__title='master', site=bar_site)
+        writer = Role.objects.get(name='writer')
+        editor = Role.objects.get(name='editor')
+        admin = Role.objects.get(name='site admin')
+        assigned_users = get_site_users(bar_site)
+        users = dict((user.username, user) for user in assigned_users)
+        submitted_users = dict(assigned_users)
+        # criss becomes a writer, vasile gets removed
+        #   and bob changes his pages
+        submitted_users[users['criss']] = writer
+        del submitted_users[users['vasile']]
+        news_bar = Page.objects.get(title_set__title='news', site=bar_site)
+        user_pages = {users['criss']: [master_bar],
+                      users['bob']: [master_bar, news_bar]}
+        changeset = SiteChangeset(
+            bar_site, assigned_users, submitted_users, user_pages)
+
+        summary = changeset.apply(dry_run=True)
+        self.assertTrue(summary['dry_run'])
+        self.assertEqual(summary['queries'], 0)
+        self.assertEqual(summary['operations'], [
+                {'action': 'ungrant', 'role': 'editor', 'users': ['criss', 'vasile']},
+                {'action': 'grant_pages', 'role': 'writer', 'users': ['bob', 'criss']}])
+        self.assertEqual(get_site_users(bar_site), assigned_users)
+
+        with override_settings(DEBUG=True):
+            summary = changeset.apply()
+        self.assertFalse(summary['dry_run'])
+        self.assertTrue(summary['queries'] > 0)
+        site_users = dict((user.username, role)
+                          for user, role in get_site_users(bar_site).iteritems())
+        self.assertNotIn('vasile', site_users)
+        self.assertEqual(site_users['criss'], writer)
+        self.assertEqual(site_users['jack'], admin)
+        self.assertItemsEqual(
+            [perm.page for perm in writer.get_user_page_perms(users['bob'], bar_site)],
+            [master_bar, news_bar])
+        self.assertEqual(editor.users(bar_site), [])
+        # the queries are only counted when they are being recorded
+        self.assertEqual(SiteChangeset(bar_site).apply()['queries'], None)
+
+    def test_unchanged_pages_left_out_of_the_plan(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        master_bar = Page.objects.get(title_set__title='master', site=bar_site)
+        assigned_users = get_site_users(bar_site)
+        bob = User.objects.get(username='bob')
+        changeset = SiteChangeset(bar_site, assigned_users,
+                                  dict(assigned_users), {bob: [master_bar]})
+        self.assertEqual(changeset.get_operations(), [])
+        self.assertEqual(len(changeset), 0)
+
+    def test_page_based_role_without_pages_is_skipped(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        writer = Role.objects.get(name='writer')
+        assigned_users = get_site_users(foo_site)
+        criss = User.objects.get(username='criss')
+        submitted_users = dict(assigned_users)
+        submitted_users[criss] = writer
+        changeset = SiteChangeset(foo_site, assigned_users, submitted_users, {})
+        self.assertEqual(changeset.skipped, [(criss, writer)])
+        self.assertEqual(changeset.get_operations(), [])
+        george = User.objects.get(username='george')
+        submitted_users[george] = writer
+        with self.assertRaises(ValidationError):
+            SiteChangeset(foo_site, assigned_users, submitted_users, {})
+
+    def test_serialized_changeset_applied_in_chunks(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        master_bar = Page.objects.get(title_set__title='master', site=bar_site)
+        writer = Role.objects.get(name='writer')
+        developer = Role.objects.get(name='developer')
+        assigned_users = get_site_users(bar_site)
+        users = dict((user.username, user) for user in assigned_users)
+        submitted_users = dict(assigned_users)
+        submitted_users[users['criss']] = writer
+        submitted_users[users['vasile']] = developer
+        changeset = SiteChangeset(bar_site, assigned_users, submitted_users,
+                                  {users['criss']: [master_bar]})
+        # both get ungranted and then granted the new roles
+        self.assertEqual(len(changeset), 4)
+        restored = SiteChangeset.from_json(bar_site, changeset.to_json())
+        self.assertEqual(restored.get_operations(), changeset.get_operations())
+
+        progress = []
+        self.assertEqual(restored.apply_in_chunks(
+                1, progress.append, lambda: progress.append(None)), 4)
+        self.assertEqual(progress, [None, 1, None, 2, None, 3, None, 4])
+        site_users = dict((user.username, role)
+                          for user, role in get_site_users(bar_site).iteritems())
+        self.assertEqual(site_users['criss'], writer)
+        self.assertEqual(site_users['vasile'], developer)
+
+    def test_run_user_setup_job(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        assigned_users = get_site_users(foo_site)
+        submitted_users = dict(assigned_users)
+        robin = User.objects.get(username='robin')
+        del submitted_users[robin]
+        changeset = SiteChangeset(foo_site, assigned_users, submitted_users, {})
+        job = UserSetupJob.objects.create(
+            site=foo_site, changes=changeset.to_json(), total=len(changeset))
+        self.assertTrue(run_user_setup_job(job))
+        job = UserSetupJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, UserSetupJob.DONE)
+        self.assertEqual(job.done, 1)
+        self.assertNotIn(robin, get_site_users(foo_site))
+        # jobs only run once
+        self.assertFalse(run_user_setup_job(job))
+
+    def test_stale_running_jobs_reclaimed(self):
+        foo_site = Site.objects.create(name='foo.site.com', domain='foo.site.com')
+        changes = SiteChangeset(foo_site).to_json()
+        stale_job = UserSetupJob.objects.create(
+            site=foo_site, changes=changes, status=UserSetupJob.RUNNING,
+            heartbeat=timezone.now() - datetime.timedelta(seconds=700))
+        running_job = UserSetupJob.objects.create(
+            site=foo_site, changes=changes, status=UserSetupJob.RUNNING,
+            heartbeat=timezone.now())
+        output = StringIO()
+        call_command('run_user_setup_jobs', stale_after=600, stdout=output)
+        self.assertIn(u'Reclaimed 1 abandoned jobs\n', output.getvalue())
+        self.assertEqual(UserSetupJob.objects.get(pk=stale_job.pk).status,
+                         UserSetupJob.DONE)
+        self.assertEqual(UserSetupJob.objects.get(pk=running_job.pk).status,
+                         UserSetupJob.RUNNING)
+
+    def test_job_skips_users_whose_pages_got_deleted(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        writer = Role.objects.get(name='writer')
+        criss = User.objects.get(username='criss')
+        vasile = User.objects.get(username='vasile')
+        bar_news = Page.objects.get(title_set__title='news', site=bar_site)
+        bar_blog = Page.objects.get(title_set__title='blog', site=bar_site)
+        assigned_users = get_site_users(bar_site)
+        submitted_users = dict(assigned_users)
+        submitted_users[criss] = writer
+        submitted_users[vasile] = writer
+        changeset = SiteChangeset(
+            bar_site, assigned_users, submitted_users,
+            {criss: [bar_news], vasile: [bar_blog]})
+        job = UserSetupJob.objects.create(
+            site=bar_site, changes=changeset.to_json(), total=len(changeset))
+        bar_news.delete()
+        run_user_setup_job(job, chunk_size=1)
+        job = UserSetupJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, UserSetupJob.DONE)
+        self.assertIn('criss', job.error)
+        self.assertEqual(get_site_users(bar_site)[vasile], writer)
+
+
 class RoleValidationTests(TestCase, HelpersMixin):
 
     def test_role_validation_two_roles_same_group(self):
@@ -537,6 +1204,112 @@ class ViewsTests(TestCase, HelpersMixin):
         self.assertEqual(user_pks_to_role_pks[george.pk], editor.pk)
         self.assertEqual(user_pks_to_role_pks[robin.pk], editor.pk)
 
+    def test_preview_changes(self):
+        self._create_simple_setup()
+        foo_site, joe, admin, george, developer, robin, editor = self._get_foo_site_objs()
+        self.client.login(username='root', password='root')
+        response = self.client.post('/admin/cmsroles/usersetup/?site=%s' % foo_site.pk, {
+                u'user-roles-MAX_NUM_FORMS': [u''],
+                u'user-roles-TOTAL_FORMS': [u'2'],
+                u'user-roles-INITIAL_FORMS': [u'2'],
+                # joe becomes a developer
+                u'user-roles-0-user': [unicode(joe.pk)],
+                u'user-roles-0-role': [unicode(developer.pk)],
+                u'user-roles-1-user': [unicode(george.pk)],
+                u'user-roles-1-role': [unicode(developer.pk)],
+                # and robin gets removed
+                u'next': [u'preview']}
+                )
+        self.assertEqual(response.status_code, 200)
+        self.assertItemsEqual(
+            [unicode(message) for message in response.context['messages']],
+            [u'Preview: ungrant site admin for joe',
+             u'Preview: ungrant editor for robin',
+             u'Preview: grant developer for joe'])
+        # nothing got changed
+        self.assertEqual(
+            dict((u.pk, r.pk) for u, r in get_site_users(foo_site).iteritems()),
+            {joe.pk: admin.pk, george.pk: developer.pk, robin.pk: editor.pk})
+
+    @override_settings(CMSROLES_USER_SETUP_JOB_THRESHOLD=2)
+    def test_large_changes_applied_in_background(self):
+        self._create_simple_setup()
+        foo_site, joe, admin, george, developer, robin, editor = self._get_foo_site_objs()
+        self.client.login(username='root', password='root')
+        response = self.client.post('/admin/cmsroles/usersetup/?site=%s' % foo_site.pk, {
+                u'user-roles-MAX_NUM_FORMS': [u''],
+                u'user-roles-TOTAL_FORMS': [u'2'],
+                u'user-roles-INITIAL_FORMS': [u'2'],
+                u'user-roles-0-user': [unicode(joe.pk)],
+                u'user-roles-0-role': [unicode(developer.pk)],
+                u'user-roles-1-user': [unicode(george.pk)],
+                u'user-roles-1-role': [unicode(developer.pk)],
+                u'next': [u'save']}
+                )
+        self.assertEqual(response.status_code, 302)
+        job = UserSetupJob.objects.get()
+        self.assertTrue(response['Location'].endswith(
+                '/admin/cmsroles/usersetup/?site=%d&job=%d' % (foo_site.pk, job.pk)))
+        self.assertEqual((job.status, job.total), (UserSetupJob.PENDING, 3))
+        # nothing gets changed until the job runs
+        self.assertEqual(get_site_users(foo_site)[robin], editor)
+
+        response = self.client.get('/admin/cmsroles/user_setup_job/?job=%d' % job.pk)
+        self.assertEqual(simplejson.loads(response.content)['status'], 'pending')
+        call_command('run_user_setup_jobs')
+        response = self.client.get('/admin/cmsroles/user_setup_job/?job=%d' % job.pk)
+        status = simplejson.loads(response.content)
+        self.assertTrue(status['finished'])
+        self.assertEqual((status['status'], status['done']), ('done', 3))
+        self.assertEqual(
+            dict((u.pk, r.pk) for u, r in get_site_users(foo_site).iteritems()),
+            {joe.pk: developer.pk, george.pk: developer.pk})
+
+    @override_settings(CMSROLES_USER_SETUP_PAGE_SIZE=2)
+    def test_paginated_and_filtered_user_setup(self):
+        self._create_simple_setup()
+        foo_site, joe, admin, george, developer, robin, editor = self._get_foo_site_objs()
+        self.client.login(username='root', password='root')
+
+        def displayed_users(**params):
+            params['site'] = foo_site.pk
+            response = self.client.get('/admin/cmsroles/usersetup/', params)
+            return [form.initial['user'] for form in response.context['user_formset']
+                    if 'user' in form.initial]
+
+        self.assertEqual(displayed_users(), [george, joe])
+        self.assertEqual(displayed_users(page=2), [robin])
+        self.assertEqual(displayed_users(page=5), [robin])
+        self.assertEqual(displayed_users(role=editor.pk), [robin])
+        self.assertEqual(displayed_users(q='JO'), [joe])
+
+    def test_save_one_page_of_users(self):
+        self._create_simple_setup()
+        foo_site, joe, admin, george, developer, robin, editor = self._get_foo_site_objs()
+        self.client.login(username='root', password='root')
+        response = self.client.post(
+            '/admin/cmsroles/usersetup/?site=%s&page=2' % foo_site.pk, {
+                u'user-roles-MAX_NUM_FORMS': [u''],
+                u'user-roles-TOTAL_FORMS': [u'2'],
+                u'user-roles-INITIAL_FORMS': [u'1'],
+                # robin, the only user on this page, becomes a developer
+                u'user-roles-0-user': [unicode(robin.pk)],
+                u'user-roles-0-role': [unicode(developer.pk)],
+                # joe, who is on another page, gets added here as a developer
+                u'user-roles-1-user': [unicode(joe.pk)],
+                u'user-roles-1-role': [unicode(developer.pk)],
+                u'displayed_users': [unicode(robin.pk)],
+                u'next': [u'continue']}
+                )
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(
+                '/admin/cmsroles/usersetup/?site=%d&page=2' % foo_site.pk))
+        # george wasn't on the submitted page so he keeps his role
+        self.assertEqual(
+            dict((u.pk, r.pk) for u, r in get_site_users(foo_site).iteritems()),
+            {joe.pk: developer.pk, george.pk: developer.pk, robin.pk: developer.pk})
+        self.assertEqual(admin.users(foo_site), [])
+
     def test_unassign_user(self):
         self._create_simple_setup()
         # users assigned to foo.site.com:
@@ -703,6 +1476,214 @@ class ViewsTests(TestCase, HelpersMixin):
         # is in the returned formset
         self.assertTrue('selected="selected"> master' in page_formset)
         
+    def test_site_assignments(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        writer = Role.objects.get(name='writer')
+        bob = User.objects.get(username='bob')
+        master_bar = Page.objects.get(title_set__title='master', site=bar_site)
+        self.client.login(username='root', password='root')
+        url = '/admin/cmsroles/site_assignments/?site=%s' % bar_site.pk
+        response = self.client.get(url)
+        content = simplejson.loads(response.content)
+        self.assertEqual(content['count'], 6)
+        users = dict((user[1], dict(zip(content['fields'], user)))
+                     for user in content['users'])
+        self.assertEqual(users['bob']['role'], writer.pk)
+        self.assertEqual(users['bob']['pages'], [master_bar.pk])
+        self.assertEqual(content['roles'][unicode(writer.pk)],
+                         {'name': 'writer', 'is_site_wide': False})
+
+        etag = response['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        writer.ungrant_from_user(bob, bar_site)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(simplejson.loads(response.content)['count'], 5)
+
+    def test_export_assignments(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        bar_site = Site.objects.get(domain='bar.site.com')
+        master_bar = Page.objects.get(title_set__title='master', site=bar_site)
+        jack = User.objects.get(username='jack')
+        jack.set_password('jack')
+        jack.save()
+        self.client.login(username='jack', password='jack')
+        url = '/admin/cmsroles/export_assignments/'
+        response = self.client.get(url, {'site': foo_site.pk})
+        self.assertEqual(response.status_code, 403)
+        # jack only administers bar.site.com
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(StringIO(response.content)))
+        self.assertEqual(rows[0], ['user', 'site', 'role', 'page'])
+        self.assertItemsEqual(rows[1:], [
+                ['joe', 'bar.site.com', 'site admin', ''],
+                ['jack', 'bar.site.com', 'site admin', ''],
+                ['robin', 'bar.site.com', 'developer', ''],
+                ['criss', 'bar.site.com', 'editor', ''],
+                ['vasile', 'bar.site.com', 'editor', ''],
+                ['bob', 'bar.site.com', 'writer', str(master_bar.pk)]])
+        response = self.client.get(url, {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_page_tree(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        self.client.login(username='root', password='root')
+        url = '/admin/cmsroles/get_page_tree/?site=%s' % bar_site.pk
+        nodes = simplejson.loads(self.client.get(url).content)['nodes']
+        self.assertEqual([(node['text'], node['has_children']) for node in nodes],
+                         [('master', True)])
+        nodes = simplejson.loads(self.client.get(
+                url, {'parent': nodes[0]['id']}).content)['nodes']
+        self.assertEqual([(node['text'], node['has_children']) for node in nodes],
+                         [('news', True), ('blog', False)])
+
+    def test_submitted_pages_validated_in_a_single_query(self):
+        def validate_pages(pages):
+            data = {u'user-1-TOTAL_FORMS': unicode(len(pages)),
+                    u'user-1-INITIAL_FORMS': u'0',
+                    u'user-1-MAX_NUM_FORMS': u''}
+            for i, page in enumerate(pages):
+                data[u'user-1-%d-page' % i] = unicode(page.pk)
+            def is_valid():
+                page_formset = PageFormSet(data, prefix='user-1')
+                self.assertTrue(page_formset.is_valid())
+            return self._count_queries(is_valid)
+
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        PageFormSet = formset_factory(_get_page_form_class(bar_site),
+                                      formset=BasePageFormSet)
+        pages = list(Page.objects.filter(site=bar_site))
+        self.assertEqual(validate_pages(pages[:1]), 1)
+        self.assertEqual(validate_pages(pages), 1)
+
+    def test_user_setup_renders_only_selected_users(self):
+        self._create_simple_setup()
+        foo_site, joe, _, _, _, _, _ = self._get_foo_site_objs()
+        criss = User.objects.get(username='criss')
+        self.client.login(username='root', password='root')
+        response = self.client.get('/admin/cmsroles/usersetup/?site=%s' % foo_site.pk)
+        self.assertContains(response, '<option value="%d" selected="selected">joe<' % joe.pk)
+        # criss isn't assigned to foo.site.com
+        self.assertNotContains(response, '<option value="%d"' % criss.pk)
+
+    def test_user_setup_query_count_independent_of_users(self):
+        def user_setup_queries(domain, user_count):
+            site = self._create_site_with_page(domain)
+            users = [User.objects.create(username='%s%d' % (domain, i))
+                     for i in range(user_count)]
+            role.grant_to_users(users, site)
+            url = '/admin/cmsroles/usersetup/?site=%s' % site.pk
+            get_queries = self._count_request_queries(self.client.get, url)
+            data = {u'user-roles-MAX_NUM_FORMS': u'',
+                    u'user-roles-TOTAL_FORMS': unicode(user_count),
+                    u'user-roles-INITIAL_FORMS': unicode(user_count),
+                    u'next': u'preview'}
+            for i, user in enumerate(users):
+                data[u'user-roles-%d-user' % i] = unicode(user.pk)
+                data[u'user-roles-%d-role' % i] = unicode(role.pk)
+            post_queries = self._count_request_queries(self.client.post, url, data)
+            return get_queries, post_queries
+
+        role = Role.objects.create(
+            name='site admin', group=self._create_site_admin_group(),
+            is_site_wide=True)
+        Role.objects.create(name='editor', group=Group.objects.create(name='editor'),
+                            is_site_wide=True)
+        self.client.login(username='root', password='root')
+        self.assertEqual(user_setup_queries('few.site.com', 2),
+                         user_setup_queries('many.site.com', 10))
+
+    def test_user_setup_rows_cached_per_site_version(self):
+        self._create_simple_setup()
+        foo_site, joe, admin, george, developer, robin, editor = self._get_foo_site_objs()
+        criss = User.objects.get(username='criss')
+        self.client.login(username='root', password='root')
+        url = '/admin/cmsroles/usersetup/?site=%s' % foo_site.pk
+        first_queries = self._count_request_queries(self.client.get, url)
+        cached_queries = self._count_request_queries(self.client.get, url)
+        self.assertTrue(cached_queries < first_queries)
+        response = self.client.get(url)
+        self.assertNotContains(response, '<option value="%d" selected="selected">' % criss.pk)
+        editor.grant_to_user(criss, foo_site)
+        response = self.client.get(url)
+        self.assertContains(response, '<option value="%d" selected="selected">' % criss.pk)
+        # renaming a user changes its label
+        criss.email = 'criss@foo.site.com'
+        criss.save()
+        response = self.client.get(url)
+        self.assertContains(response, 'criss@foo.site.com')
+
+    def test_user_setup_rows_and_etag_change_on_user_deletion(self):
+        self._create_simple_setup()
+        foo_site, joe, admin, george, developer, robin, editor = self._get_foo_site_objs()
+        self.client.login(username='root', password='root')
+        url = '/admin/cmsroles/usersetup/?site=%s' % foo_site.pk
+        assignments_url = '/admin/cmsroles/site_assignments/?site=%s' % foo_site.pk
+        selected_robin = '<option value="%d" selected="selected">' % robin.pk
+        self.assertContains(self.client.get(url), selected_robin)
+        etag = self.client.get(assignments_url)['ETag']
+        robin.delete()
+        self.assertNotContains(self.client.get(url), selected_robin)
+        response = self.client.get(assignments_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_search_users(self):
+        for i in range(25):
+            User.objects.create(username='user%02d' % i, email='u%02d@x.com' % i)
+        User.objects.create(username='inactive', is_active=False)
+        self.client.login(username='root', password='root')
+        response = self.client.get('/admin/cmsroles/search_users/', {'q': 'USER'})
+        content = simplejson.loads(response.content)
+        self.assertEqual(len(content['results']), 20)
+        self.assertTrue(content['more'])
+        self.assertEqual(content['results'][0]['text'], 'user00 - u00@x.com')
+        response = self.client.get('/admin/cmsroles/search_users/',
+                                   {'q': 'user', 'page': 2})
+        content = simplejson.loads(response.content)
+        self.assertEqual(len(content['results']), 5)
+        self.assertFalse(content['more'])
+        response = self.client.get('/admin/cmsroles/search_users/', {'q': 'inact'})
+        self.assertEqual(simplejson.loads(response.content)['results'], [])
+
+    def test_get_page_formsets(self):
+        self._create_simple_setup()
+        bar_site = Site.objects.get(domain='bar.site.com')
+        writer = Role.objects.get(name='writer')
+        admin = Role.objects.get(name='site admin')
+        bob = User.objects.get(username='bob')
+        jack = User.objects.get(username='jack')
+        pages = list(Page.objects.filter(site=bar_site, title_set__title__in=['news', 'blog']))
+        writers = [User.objects.create(username='writer%d' % i) for i in range(3)]
+        writer.grant_to_users(writers, bar_site, pages)
+        self.client.login(username='root', password='root')
+
+        def get_page_formsets(users, roles):
+            url = '/admin/cmsroles/get_page_formsets/'
+            params = {'site': bar_site.pk,
+                      'user': [user.pk for user in users],
+                      'role': [role.pk for role in roles]}
+            queries = self._count_request_queries(self.client.get, url, params)
+            return queries, simplejson.loads(self.client.get(url, params).content)
+
+        few_queries, content = get_page_formsets([bob], [writer])
+        self.assertTrue('selected="selected"> master' in content['page_formsets'][unicode(bob.pk)])
+        many_queries, content = get_page_formsets(
+            [bob, jack] + writers, [writer, admin] + [writer] * 3)
+        self.assertEqual(few_queries, many_queries)
+        self.assertEqual(content['errors'].keys(), [unicode(jack.pk)])
+        self.assertEqual(len(content['page_formsets']), 4)
+        writer_formset = content['page_formsets'][unicode(writers[0].pk)]
+        self.assertTrue('selected="selected">--- news' in writer_formset)
+        self.assertTrue('selected="selected">--- blog' in writer_formset)
+
     def test_no_duplicate_groups_in_the_group_admin(self):
         site_admin_group = self._create_site_admin_group()
         Role.objects.create(
@@ -729,8 +1710,10 @@ class ManagePagePermissionsCommandTests(TestCase, HelpersMixin):
         bob = User.objects.get(username='bob')
         bar_news = Page.objects.get(title_set__title='news', site=bar_site)
         unmanaged_perm = PagePermission.objects.create(user=bob, page=bar_news)
+        version = get_site_version(bar_site)[0]
         call_command('manage_page_permissions', role='writer')
         self.assertIn(unmanaged_perm, writer_role.derived_page_permissions.all())
+        self.assertNotEqual(get_site_version(bar_site)[0], version)
 
     def test_site_not_writer_on(self):
         self._create_simple_setup()
@@ -757,3 +1740,96 @@ class ManagePagePermissionsCommandTests(TestCase, HelpersMixin):
         self.assertEqual(len(command.errors), 1)
         self.assertNotIn(bob, writer_role.users(foo_site))
         self.assertNotIn(unmanaged_perm, writer_role.derived_page_permissions.all())
+
+
+class ExportRoleAssignmentsCommandTests(TestCase, HelpersMixin):
+
+    def test_export_jsonl_in_chunks(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        writer_role = Role.objects.get(name='writer')
+        bob = User.objects.get(username='bob')
+        foo_news = Page.objects.get(title_set__title='news', site=foo_site)
+        foo_blog = Page.objects.get(title_set__title='blog', site=foo_site)
+        writer_role.grant_to_user(bob, foo_site, [foo_news, foo_blog])
+        stdout = StringIO()
+        call_command('export_role_assignments', format='jsonl',
+                     sites=['foo.site.com'], chunk_size=2, stdout=stdout)
+        rows = [simplejson.loads(line)
+                for line in stdout.getvalue().splitlines()]
+        self.assertItemsEqual(rows, [
+                {'user': 'joe', 'site': 'foo.site.com', 'role': 'site admin',
+                 'page': None},
+                {'user': 'george', 'site': 'foo.site.com',
+                 'role': 'developer', 'page': None},
+                {'user': 'robin', 'site': 'foo.site.com', 'role': 'editor',
+                 'page': None},
+                {'user': 'bob', 'site': 'foo.site.com', 'role': 'writer',
+                 'page': foo_news.pk},
+                {'user': 'bob', 'site': 'foo.site.com', 'role': 'writer',
+                 'page': foo_blog.pk}])
+        stdout = StringIO()
+        call_command('export_role_assignments', roles=['editor'],
+                     stdout=stdout)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 4)
+        with self.assertRaises(CommandError):
+            export_role_assignments.Command().handle(
+                format='csv', sites=['nowhere.com'], roles=None,
+                chunk_size=1000)
+
+
+class ImportRoleAssignmentsCommandTests(TestCase, HelpersMixin):
+
+    def _write_file(self, suffix, content):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.write(fd, content)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_import_is_idempotent(self):
+        self._create_simple_setup()
+        foo_site = Site.objects.get(domain='foo.site.com')
+        bar_site = Site.objects.get(domain='bar.site.com')
+        foo_news = Page.objects.get(title_set__title='news', site=foo_site)
+        foo_blog = Page.objects.get(title_set__title='blog', site=foo_site)
+        bar_blog = Page.objects.get(title_set__title='blog', site=bar_site)
+        path = self._write_file('.csv', '\n'.join([
+                    'user,site,role,page',
+                    'george,bar.site.com,developer,',
+                    'bob,foo.site.com,writer,%d' % foo_news.pk,
+                    'bob,foo.site.com,writer,%d' % foo_blog.pk,
+                    'joe,foo.site.com,site admin,',
+                    'criss,bar.site.com,developer,',
+                    'nobody,bar.site.com,developer,',
+                    'vasile,foo.site.com,writer,%d' % bar_blog.pk,
+                    'vasile,foo.site.com,editor,%d' % foo_news.pk]))
+        command = import_role_assignments.Command()
+        command.execute(path, format=None, chunk_size=3, stdout=StringIO())
+        self.assertEqual(command.report['granted'], 3)
+        self.assertEqual(command.report['unchanged'], 1)
+        self.assertEqual([line_num for line_num, reason
+                          in command.report['rejected']], [6, 7, 8, 9])
+        developer = Role.objects.get(name='developer')
+        writer = Role.objects.get(name='writer')
+        george = User.objects.get(username='george')
+        bob = User.objects.get(username='bob')
+        self.assertIn(george, developer.users(bar_site))
+        self.assertItemsEqual(
+            [perm.page for perm in writer.get_user_page_perms(bob, foo_site)],
+            [foo_news, foo_blog])
+        # bob keeps the pages he already had on bar.site.com
+        self.assertEqual(writer.get_user_page_perms(bob, bar_site).count(), 1)
+
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        starting_queries = len(connection.queries)
+        try:
+            command.execute(path, format=None, chunk_size=3, stdout=StringIO())
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        self.assertEqual(command.report['granted'], 0)
+        self.assertEqual(command.report['unchanged'], 4)
+        self.assertFalse([query for query
+                          in connection.queries[starting_queries:]
+                          if not query['sql'].startswith('SELECT')])
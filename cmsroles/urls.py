@@ -3,4 +3,13 @@ from django.conf.urls import patterns, url
 urlpatterns = patterns('cmsroles.views',
     url(r'^usersetup/$', 'user_setup', name='user_setup'),
     url(r'^get_page_formset/$', 'get_page_formset', name='get_page_formset'),
+    url(r'^get_page_formsets/$', 'get_page_formsets',
+        name='get_page_formsets'),
+    url(r'^site_assignments/$', 'site_assignments', name='site_assignments'),
+    url(r'^get_page_tree/$', 'get_page_tree', name='get_page_tree'),
+    url(r'^search_users/$', 'search_users', name='search_users'),
+    url(r'^user_setup_job/$', 'user_setup_job_status',
+        name='user_setup_job_status'),
+    url(r'^export_assignments/$', 'export_assignments',
+        name='export_assignments'),
 )
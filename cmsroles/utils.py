@@ -0,0 +1,58 @@
+from itertools import islice
+
+from django.db import connections, transaction
+from django.db.models.sql.datastructures import EmptyResultSet
+
+
+# sqlite refuses statements having more than 999 bound parameters so
+# 'IN' lookups over large id lists need to be split
+MAX_IN_CLAUSE_SIZE = 500
+
+
+def chunked(iterable, size=MAX_IN_CLAUSE_SIZE):
+    """Yields lists of at most size items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_create(model, objs):
+    """Inserts objs with model's bulk_create. Besides the backend's limit
+    of bound parameters, batches are also kept under MAX_IN_CLAUSE_SIZE
+    rows since sqlite inserts multiple rows through a compound SELECT,
+    which can't have more than 500 terms.
+    """
+    objs = list(objs)
+    if not objs:
+        return
+    ops = connections[model.objects.db].ops
+    batch_size = min(MAX_IN_CLAUSE_SIZE, max(
+            ops.bulk_batch_size(model._meta.local_fields, objs), 1))
+    model.objects.bulk_create(objs, batch_size=batch_size)
+
+
+def delete_in_bulk(queryset):
+    """Deletes the rows matched by queryset with a single DELETE statement.
+    Unlike QuerySet.delete this neither fetches the objects nor sends
+    any signals, so rows referencing the deleted ones need to be taken
+    care of by the caller. Returns the number of deleted rows.
+    """
+    model = queryset.model
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    try:
+        subquery, params = queryset.order_by().values('pk').query\
+            .get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return 0
+    # the extra derived table keeps MySQL from complaining about
+    #   selecting from the table that is being deleted from
+    sql = 'DELETE FROM %s WHERE %s IN (SELECT * FROM (%s) AS matched)' % (
+        qn(model._meta.db_table), qn(model._meta.pk.column), subquery)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed(using=queryset.db)
+    return cursor.rowcount
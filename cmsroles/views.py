@@ -1,43 +1,186 @@
+import hashlib
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
+from django.core import validators
 from django.core.exceptions import PermissionDenied
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.core.urlresolvers import reverse
 from django.db import transaction
+from django.db.models import Q
 from django import forms
 from django.forms.formsets import formset_factory, BaseFormSet
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, \
+    HttpResponseBadRequest, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext, loader, Context
-from django.utils.encoding import smart_unicode
+from django.utils.encoding import force_unicode, smart_unicode
+from django.utils.html import conditional_escape
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
 from django.utils import simplejson
+from django.utils.translation import get_language
+from django.views.decorators.http import condition
 
 from cms.models.pagemodel import Page
+from cms.models.titlemodels import Title
 
 from mptt.forms import TreeNodeChoiceField
 
-from cmsroles.siteadmin import get_administered_sites, \
-    get_site_users, is_site_admin
-from cmsroles.models import Role
+from cmsroles.changeset import SiteChangeset
+from cmsroles.export import EXPORT_FORMATS, iter_assignments
+from cmsroles.siteadmin import get_administered_site_ids, \
+    get_cached_administered_sites_queryset, \
+    get_site_pk_by_domain, get_site_user_rows, get_site_users, is_site_admin
+from cmsroles.models import Role, UserSetupJob, get_site_version
+from cmsroles.utils import chunked
 
 
-class UserChoiceField(forms.ModelChoiceField):
+# how many users a search_users call returns at once
+USER_SEARCH_PAGE_SIZE = 20
 
-    def label_from_instance(self, obj):
-        if obj.first_name and obj.last_name and obj.email:
-            return u'%s %s (%s)' % (obj.first_name, obj.last_name, obj.email)
-        elif obj.email:
-            return obj.email
+# how many users a site_assignments call returns at once
+SITE_ASSIGNMENTS_PAGE_SIZE = 500
+
+# user setup query parameters selecting which assignments are shown
+USER_SETUP_FILTER_PARAMS = ('role', 'q', 'page')
+
+
+def _get_user_label(user):
+    # the username is always shown since Chosen also filters the options
+    #   by their labels, which would hide users matched by username only
+    if user.first_name and user.last_name and user.email:
+        return u'%s - %s %s (%s)' % (user.username, user.first_name,
+                                     user.last_name, user.email)
+    elif user.email:
+        return u'%s - %s' % (user.username, user.email)
+    else:
+        return smart_unicode(user)
+
+
+def _to_pk(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SelectedChoicesSelect(forms.Select):
+    """A select box that renders only the selected choices instead of
+    all of the field's choices.
+    """
+
+    # pk -> object mapping shared by all of a formset's forms
+    objects = None
+
+    def render_options(self, choices, selected_choices):
+        field = self.choices.field
+        selected_choices = set(force_unicode(pk) for pk in selected_choices)
+        selected_pks = filter(None, map(_to_pk, selected_choices))
+        options = [self.render_option(selected_choices, '', field.empty_label)]
+        if not selected_pks:
+            selected_objs = []
+        elif self.objects is None:
+            selected_objs = self.choices.queryset.filter(pk__in=selected_pks)
         else:
-            return smart_unicode(obj)
+            selected_objs = [self.objects[pk] for pk in selected_pks
+                             if pk in self.objects]
+        for obj in selected_objs:
+            options.append(self.render_option(
+                    selected_choices, obj.pk, field.label_from_instance(obj)))
+        return u'\n'.join(options)
+
+
+class UserSearchSelect(SelectedChoicesSelect):
+    """The other users are loaded on demand from the search_users view"""
+
+
+class PageTreeSelect(SelectedChoicesSelect):
+    """The other pages are picked from a page tree whose nodes are loaded
+    on demand from the get_page_tree view.
+    """
+
+
+class SharedChoicesMixin(object):
+    """Model choice field that looks the submitted objects up in a
+    pk -> object mapping shared by all of a formset's forms, instead
+    of querying for them once per form.
+    """
+
+    objects = None
+
+    def to_python(self, value):
+        if self.objects is None or value in validators.EMPTY_VALUES:
+            return super(SharedChoicesMixin, self).to_python(value)
+        try:
+            return self.objects[int(value)]
+        except (ValueError, TypeError, KeyError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'])
+
+
+class UserChoiceField(SharedChoicesMixin, forms.ModelChoiceField):
+
+    widget = UserSearchSelect
+
+    def label_from_instance(self, obj):
+        return _get_user_label(obj)
+
+
+class RoleChoiceField(SharedChoicesMixin, forms.ModelChoiceField):
+    pass
+
+
+class PageChoiceField(SharedChoicesMixin, TreeNodeChoiceField):
+
+    widget = PageTreeSelect
+
+    # page pk -> title mapping shared by all of a formset's forms and
+    #   filled in for all of the formset's pages on first use
+    titles = None
+
+    def label_from_instance(self, obj):
+        if self.titles is None or self.objects is None:
+            return super(PageChoiceField, self).label_from_instance(obj)
+        if obj.pk not in self.titles:
+            self.titles.update(dict.fromkeys(self.objects))
+            self.titles.update(_get_page_titles(self.objects))
+        title = self.titles[obj.pk]
+        if title is None:
+            title = smart_unicode(obj)
+        return mark_safe(u'%s %s' % (self._get_level_indicator(obj),
+                                     conditional_escape(title)))
+
+
+def _get_formset_objects(formset, field_name, queryset):
+    """Returns a pk -> object mapping of the objects that are either
+    submitted or initial values of field_name in any of formset's forms.
+    Uses one query per MAX_IN_CLAUSE_SIZE objects.
+    """
+    pks = set()
+    if formset.is_bound:
+        for i in xrange(formset.total_form_count()):
+            pks.add(_to_pk(formset.data.get(
+                        '%s-%s' % (formset.add_prefix(i), field_name), None)))
+    for initial in formset.initial or []:
+        value = initial.get(field_name, None)
+        pks.add(getattr(value, 'pk', _to_pk(value)))
+    pks.discard(None)
+    objects = {}
+    for pks_chunk in chunked(pks):
+        objects.update((obj.pk, obj)
+                       for obj in queryset.filter(pk__in=pks_chunk))
+    return objects
 
 
 class UserForm(forms.Form):
     user = UserChoiceField(
         queryset=User.objects.filter(is_active=True),
         required=False)
-    role = forms.ModelChoiceField(
+    role = RoleChoiceField(
         queryset=Role.objects.all(),
         required=False)
 
@@ -51,6 +194,31 @@ class UserForm(forms.Form):
 
 
 class BaseUserFormSet(BaseFormSet):
+    """Resolves the roles and the submitted or initial users once and
+    shares them with all of its forms, so the number of queries doesn't
+    grow with the number of forms.
+    """
+
+    def _construct_forms(self):
+        self._resolve_choices()
+        super(BaseUserFormSet, self)._construct_forms()
+
+    def _resolve_choices(self):
+        self.roles = list(Role.objects.all())
+        self._roles_by_pk = dict((role.pk, role) for role in self.roles)
+        self.users = _get_formset_objects(
+            self, 'user', User.objects.filter(is_active=True))
+
+    def _construct_form(self, i, **kwargs):
+        form = super(BaseUserFormSet, self)._construct_form(i, **kwargs)
+        role_field = form.fields['role']
+        role_field.objects = self._roles_by_pk
+        role_field.choices = [(u'', role_field.empty_label)] + [
+            (role.pk, role_field.label_from_instance(role))
+            for role in self.roles]
+        user_field = form.fields['user']
+        user_field.objects = user_field.widget.objects = self.users
+        return form
 
     def clean(self):
         if any(self.errors):
@@ -68,6 +236,37 @@ class BaseUserFormSet(BaseFormSet):
             users.add(user)
 
 class BasePageFormSet(BaseFormSet):
+    """Resolves all of the submitted or initial pages with a single
+    query and shares them with its forms. Initial pages that are given
+    as Page objects don't need to be looked up at all.
+
+    page_titles is a page pk -> title mapping that formsets rendered
+    together can share.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._page_titles = kwargs.pop('page_titles', None)
+        if self._page_titles is None:
+            self._page_titles = {}
+        super(BasePageFormSet, self).__init__(*args, **kwargs)
+
+    def _construct_forms(self):
+        initial_pages = [initial.get('page', None)
+                         for initial in self.initial or []]
+        if not self.is_bound and all(isinstance(page, Page)
+                                     for page in initial_pages):
+            self.pages = dict((page.pk, page) for page in initial_pages)
+        else:
+            self.pages = _get_formset_objects(
+                self, 'page', self.form.base_fields['page'].queryset)
+        super(BasePageFormSet, self)._construct_forms()
+
+    def _construct_form(self, i, **kwargs):
+        form = super(BasePageFormSet, self)._construct_form(i, **kwargs)
+        page_field = form.fields['page']
+        page_field.objects = page_field.widget.objects = self.pages
+        page_field.titles = self._page_titles
+        return form
 
     def clean(self):
         if any(self.errors):
@@ -86,20 +285,15 @@ class BasePageFormSet(BaseFormSet):
 
 
 def _get_user_sites(user, site_pk):
-    administered_sites = get_administered_sites(user)
-    if not administered_sites:
-        raise PermissionDenied()
-
-    if not site_pk:
-        return (administered_sites[0], administered_sites)
-
-    site_pk = int(site_pk)
-    if all(site_pk != s.pk for s in administered_sites):
+    administered_sites = get_cached_administered_sites_queryset(user)
+    try:
+        if not site_pk:
+            current_site = administered_sites[0]
+        else:
+            current_site = administered_sites.get(pk=int(site_pk))
+    except (IndexError, Site.DoesNotExist):
         raise PermissionDenied()
-    else:
-        return (next((s for s in administered_sites if site_pk == s.pk),
-                     administered_sites[0]),
-                administered_sites)
+    return (current_site, administered_sites)
 
 
 def _get_site_pk(request):
@@ -113,46 +307,46 @@ def _get_site_pk(request):
 
     host = request.META.get('HTTP_HOST', None)
     if host is not None:
-        try:
-            site_pk = Site.objects.get(domain=host).pk
-        except Site.DoesNotExist:
-            pass
+        site_pk = get_site_pk_by_domain(host)
     return site_pk
 
 
-def _update_site_users(request, site, assigned_users, submitted_users, user_pages):
-    newly_assigned_users = {}
-    existing_users = {}
-    for user, role in submitted_users.iteritems():
-        if user not in assigned_users:
-            newly_assigned_users[user] = role
-        else:
-            existing_users[user] = role
-
-    unassigned_users = dict(
-        (user, role) for user, role in assigned_users.iteritems()
-        if user not in existing_users.keys())
-
-    for user, role in unassigned_users.iteritems():
-        role.ungrant_from_user(user, site)
-    for user, role in newly_assigned_users.iteritems():
-        pages = user_pages.get(user, None)
-        if not role.is_site_wide and pages is None:
-            # this is very unlikely but can happen if someone changes the role
-            # between the moment user setup page is rendered and the moment
-            # the forms are submitted
-            messages.error(
-                request, "Role %s got changed and is no longer site wide. "
-                "User %s didn't get the role because "
-                "no pages were submitted. Try again" % (user, role))
-        else:
-            role.grant_to_user(user, site, pages)
-    for user, new_role in existing_users.iteritems():
-        previous_role = assigned_users[user]
-        pages = user_pages.get(user, None)
-        if previous_role != new_role or pages is not None:
-            previous_role.ungrant_from_user(user, site)
-            new_role.grant_to_user(user, site, pages)
+def _report_skipped_users(request, changeset):
+    for user, role in changeset.skipped:
+        messages.error(
+            request, "Role %s got changed and is no longer site wide. "
+            "User %s didn't get the role because "
+            "no pages were submitted. Try again" % (role, user))
+
+
+def _update_site_users(request, changeset, dry_run=False):
+    summary = changeset.apply(dry_run=dry_run)
+    if dry_run:
+        for operation in summary['operations']:
+            messages.info(request, u'Preview: %s %s for %s' % (
+                    operation['action'].replace('_', ' '),
+                    operation['role'], ', '.join(operation['users'])))
+        if not summary['operations']:
+            messages.info(request, u'Preview: nothing changed')
+    return summary
+
+
+def _queue_site_users_update(request, changeset):
+    """Leaves applying an already planned changeset to a background job,
+    so validation errors are still reported on submit. Returns the job or
+    None if the changes are small enough to be applied while serving the
+    request.
+    """
+    threshold = getattr(settings, 'CMSROLES_USER_SETUP_JOB_THRESHOLD', None)
+    if threshold is None or len(changeset) < threshold:
+        return None
+    job = UserSetupJob.objects.create(
+        site=changeset.site, created_by=request.user,
+        changes=changeset.to_json(),
+        total=len(changeset))
+    messages.info(request, u'%d user changes are being applied in the '
+                  'background' % job.total)
+    return job
 
 
 def _get_user_pages(page_formset):
@@ -164,13 +358,22 @@ def _get_user_pages(page_formset):
     return pages
 
 
-def _get_redirect(request, site_pk):
+def _get_redirect(request, site_pk, job=None):
     next_action = request.POST['next']
-    if next_action == u'continue':
+    if next_action == u'continue' or job is not None:
+        params = []
         if site_pk is not None:
-            next_url = '%s?site=%s' % (reverse(user_setup), site_pk)
-        else:
-            next_url = reverse(user_setup)
+            params.append('site=%s' % site_pk)
+        # stay on the same page of the filtered assignments
+        params.extend(
+            urlencode({key: request.GET[key]})
+            for key in USER_SETUP_FILTER_PARAMS if request.GET.get(key))
+        if job is not None:
+            # so the progress of the job can be followed
+            params.append('job=%d' % job.pk)
+        next_url = reverse(user_setup)
+        if params:
+            next_url = '%s?%s' % (next_url, '&'.join(params))
         return HttpResponseRedirect(next_url)
     else:
         return HttpResponseRedirect('/admin/')
@@ -178,13 +381,74 @@ def _get_redirect(request, site_pk):
 def _get_page_form_class(current_site):
 
     class PageForm(forms.Form):
-        page = TreeNodeChoiceField(
+        page = PageChoiceField(
             queryset=Page.objects.filter(site=current_site),
             required=False)
 
     return PageForm
 
 
+def _get_users_role_pages(site, user_role_pks):
+    """Returns a (user pk, role pk) -> pages mapping of the pages each
+    user got from the paired role on site. Uses a single query.
+    """
+    user_pks = set(user_pk for user_pk, role_pk in user_role_pks)
+    role_pks = set(role_pk for user_pk, role_pk in user_role_pks)
+    users_role_pages = dict((pair, []) for pair in user_role_pks)
+    if not user_role_pks:
+        return users_role_pages
+    PagePermissions = Role.derived_page_permissions.through
+    derived_page_perms = PagePermissions.objects.filter(
+        role__in=role_pks, pagepermission__user__in=user_pks,
+        pagepermission__page__site=site).select_related(
+        'pagepermission__page')
+    for derived_page_perm in derived_page_perms:
+        page_perm = derived_page_perm.pagepermission
+        pair = (page_perm.user_id, derived_page_perm.role_id)
+        if pair in users_role_pages:
+            users_role_pages[pair].append(page_perm.page)
+    for pages in users_role_pages.itervalues():
+        pages.sort(key=lambda page: (page.tree_id, page.lft))
+    return users_role_pages
+
+
+def _render_page_formsets(site, user_role_pks):
+    """Renders the page formsets of the given (user pk, role pk) pairs
+    sharing the page choices and titles between them. Returns a user
+    pk -> (rendered formset, error message) mapping.
+    """
+    roles = Role.objects.in_bulk(
+        set(role_pk for user_pk, role_pk in user_role_pks))
+    users_role_pages = _get_users_role_pages(site, [
+            (user_pk, role_pk) for user_pk, role_pk in user_role_pks
+            if role_pk in roles and not roles[role_pk].is_site_wide])
+    page_titles = _get_page_titles(set(
+            page.pk for pages in users_role_pages.itervalues()
+            for page in pages))
+    PageFormSet = formset_factory(
+        _get_page_form_class(site), formset=BasePageFormSet, extra=1)
+    template = loader.get_template('admin/cmsroles/page_formset.html')
+    rendered = {}
+    for user_pk, role_pk in user_role_pks:
+        if role_pk not in roles:
+            rendered[user_pk] = (None, 'This role was deleted in the '
+                                 'meanwhile. The assign pages link is '
+                                 'obsolete')
+        elif roles[role_pk].is_site_wide:
+            rendered[user_pk] = (None, 'This role was changed to being site '
+                                 'wide in the meanwhile. The assign pages '
+                                 'link is obsolete')
+        else:
+            page_formset = PageFormSet(
+                initial=[{'page': page} for page in
+                         users_role_pages[(user_pk, role_pk)]],
+                prefix='user-%d' % user_pk, page_titles=page_titles)
+            rendered[user_pk] = (
+                template.render(Context({'page_formset': page_formset})),
+                None)
+    return rendered
+
+
 @user_passes_test(is_site_admin, login_url='/admin/')
 def get_page_formset(request):
     """Returns the page formset for a given user. This is meant to
@@ -199,33 +463,56 @@ def get_page_formset(request):
     # this is requred for making sure the pages formset is properly built
     assert site_pk is not None
     current_site, administered_sites = _get_user_sites(request.user, site_pk)
-    PageFormSet = formset_factory(
-        _get_page_form_class(current_site),
-        formset=BasePageFormSet, extra=1)
-    user_pk = request.GET.get('user')
-    role_pk = request.GET.get('role')
-    role = Role.objects.get(pk=role_pk)
-    user = User.objects.get(pk=user_pk)
-    if role.is_site_wide:
+    user = User.objects.get(pk=request.GET.get('user'))
+    role_pk = int(request.GET.get('role'))
+    rendered_formset, error_msg = _render_page_formsets(
+        current_site, [(user.pk, role_pk)])[user.pk]
+    if error_msg is not None:
         return HttpResponse(simplejson.dumps({
                     'success': False,
-                    'error_msg': 'This role was changed to being site '\
-                        'wide in the meanwhile. The assign pages link is '\
-                        'obsolete'}),
+                    'error_msg': error_msg}),
                             content_type="application/json")
-    page_perms = role.get_user_page_perms(user, current_site)
-    page_formset = PageFormSet(
-        initial=[{'page': page_perm.page} for page_perm in page_perms],
-        prefix='user-%d' % user.pk)
-    rendered_formset = loader.get_template(
-        'admin/cmsroles/page_formset.html').render(
-        Context({'page_formset': page_formset}))
     response = {'page_formset': rendered_formset,
                 'success': True}
     return HttpResponse(simplejson.dumps(response),
                         content_type="application/json")
 
 
+@user_passes_test(is_site_admin, login_url='/admin/')
+def get_page_formsets(request):
+    """Batch variant of get_page_formset, returning the page formsets of
+    many users in one go. Takes lists of 'user' and 'role' parameters,
+    the n-th role being the one whose pages the n-th user gets.
+    """
+    site_pk = _get_site_pk(request)
+    assert site_pk is not None
+    current_site, administered_sites = _get_user_sites(request.user, site_pk)
+    user_pks = map(_to_pk, request.GET.getlist('user'))
+    role_pks = map(_to_pk, request.GET.getlist('role'))
+    if len(user_pks) != len(role_pks) or None in user_pks + role_pks:
+        return HttpResponseBadRequest(
+            'Each user needs to be paired with a role')
+    existing_user_pks = set()
+    for user_pks_chunk in chunked(set(user_pks)):
+        existing_user_pks.update(User.objects.filter(
+                pk__in=user_pks_chunk).values_list('pk', flat=True))
+    rendered = _render_page_formsets(current_site, [
+            (user_pk, role_pk) for user_pk, role_pk in zip(user_pks, role_pks)
+            if user_pk in existing_user_pks])
+    response = {
+        'success': True,
+        'page_formsets': dict(
+            (user_pk, rendered_formset)
+            for user_pk, (rendered_formset, error_msg) in rendered.iteritems()
+            if error_msg is None),
+        'errors': dict(
+            (user_pk, error_msg)
+            for user_pk, (rendered_formset, error_msg) in rendered.iteritems()
+            if error_msg is not None)}
+    return HttpResponse(simplejson.dumps(response),
+                        content_type="application/json")
+
+
 def _formset_available(request, user):
     return 'user-%d-INITIAL_FORMS' % user.pk in request.POST.keys()
 
@@ -234,13 +521,97 @@ def _get_page_formset_prefix(user):
     return 'user-%d' % user.pk
 
 
+def _get_assignments_page(request, site):
+    """Returns the requested page of the site's (user_id, username, email,
+    role_id) rows, filtered by the role and username or email search
+    parameters.
+    """
+    rows = get_site_user_rows(site)
+    role_pk = _to_pk(request.GET.get('role', None))
+    if role_pk is not None:
+        rows = [row for row in rows if row[3] == role_pk]
+    term = request.GET.get('q', '').strip().lower()
+    if term:
+        rows = [row for row in rows
+                if term in row[1].lower() or term in row[2].lower()]
+    rows.sort(key=lambda row: row[1])
+    paginator = Paginator(rows, getattr(
+            settings, 'CMSROLES_USER_SETUP_PAGE_SIZE', 100))
+    try:
+        return paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        return paginator.page(1)
+    except EmptyPage:
+        return paginator.page(paginator.num_pages)
+
+
+def _get_displayed_user_pks(request):
+    """Returns the pks of the users that were shown on the submitted
+    page or None when the submission doesn't say"""
+    displayed_users = request.POST.get('displayed_users', None)
+    if displayed_users is None:
+        return None
+    return set(filter(None, map(_to_pk, displayed_users.split(','))))
+
+
+def _get_pagination(assignments_page):
+    return {
+        'number': assignments_page.number,
+        'num_pages': assignments_page.paginator.num_pages,
+        'count': assignments_page.paginator.count,
+        'previous': (assignments_page.previous_page_number()
+                     if assignments_page.has_previous() else None),
+        'next': (assignments_page.next_page_number()
+                 if assignments_page.has_next() else None)}
+
+
+def _render_user_rows(user_formset, page_formsets, displayed_user_pks,
+                      assignments_page):
+    return {
+        'html': loader.render_to_string(
+            'admin/cmsroles/user_formset.html',
+            {'user_formset': user_formset, 'page_formsets': page_formsets}),
+        'form_count': len(user_formset),
+        'displayed_users': ','.join(
+            unicode(pk) for pk in sorted(displayed_user_pks)),
+        'pagination': _get_pagination(assignments_page)}
+
+
+def _get_user_rows(request, site):
+    """Returns the rendered user formset of the requested page of site's
+    assignments. The rendered rows are cached until the assignments of
+    the site, its roles or its site groups change.
+    """
+    version, modified = get_site_version(site)
+    cache_key = 'cmsroles-user-setup-%s' % hashlib.md5(repr((
+                site.pk, version, modified.isoformat(),
+                [request.GET.get(key, '') for key in USER_SETUP_FILTER_PARAMS]
+                ))).hexdigest()
+    user_rows = cache.get(cache_key)
+    if user_rows is None:
+        assignments_page = _get_assignments_page(request, site)
+        displayed_user_pks = [row[0] for row in assignments_page.object_list]
+        assigned_users = get_site_users(site, displayed_user_pks)
+        initial_data = [
+            {'user': user, 'role': role, 'current_site': site}
+            for user, role in sorted(assigned_users.iteritems(),
+                                     key=lambda item: item[0].username)]
+        UserFormSet = formset_factory(
+            UserForm, formset=BaseUserFormSet, extra=1)
+        user_formset = UserFormSet(initial=initial_data, prefix='user-roles')
+        user_rows = _render_user_rows(
+            user_formset, {}, displayed_user_pks, assignments_page)
+        cache.set(cache_key, user_rows, getattr(
+                settings, 'CMSROLES_USER_SETUP_CACHE_TIMEOUT', 3600))
+    return user_rows
+
+
 @user_passes_test(is_site_admin, login_url='/admin/')
 @transaction.commit_on_success
 def user_setup(request):
     site_pk = _get_site_pk(request)
     current_site, administered_sites = _get_user_sites(request.user, site_pk)
     UserFormSet = formset_factory(UserForm, formset=BaseUserFormSet, extra=1)
-    assigned_users = get_site_users(current_site)
     PageFormSet = formset_factory(
         _get_page_form_class(current_site),
         formset=BasePageFormSet, extra=1)
@@ -248,6 +619,10 @@ def user_setup(request):
     if request.method == 'POST':
         user_formset = UserFormSet(request.POST, request.FILES,
                                    prefix='user-roles')
+        displayed_user_pks = _get_displayed_user_pks(request)
+        if displayed_user_pks is None:
+            displayed_user_pks = set(
+                row[0] for row in get_site_user_rows(current_site))
         user_pages = {}
         if user_formset.is_valid():
             submitted_users = {}
@@ -265,20 +640,44 @@ def user_setup(request):
                     if page_formset.is_valid():
                         user_pages[user] = _get_user_pages(page_formset)
                     else:
-                        page_formsets[unicode(user.pk)] = page_formset
                         page_formsets_have_errors = True
+                    # so the submitted pages don't get lost when
+                    #   the page is rendered again
+                    page_formsets[unicode(user.pk)] = page_formset
             if not page_formsets_have_errors:
-                _update_site_users(request, current_site, assigned_users,
-                                   submitted_users, user_pages)
-                return _get_redirect(request, site_pk)
-
+                # users on other pages are left alone, unless they
+                #   got added to this page with a different role
+                assigned_users = get_site_users(
+                    current_site, displayed_user_pks |
+                    set(user.pk for user in submitted_users))
+                changeset = SiteChangeset(current_site, assigned_users,
+                                          submitted_users, user_pages)
+                _report_skipped_users(request, changeset)
+                preview = request.POST.get('next', None) == u'preview'
+                job = None
+                if not preview:
+                    job = _queue_site_users_update(request, changeset)
+                if job is None:
+                    _update_site_users(request, changeset, dry_run=preview)
+                if not preview:
+                    return _get_redirect(request, site_pk, job)
+        # submitted forms are rendered again, with their errors
+        user_rows = _render_user_rows(
+            user_formset, page_formsets, displayed_user_pks,
+            _get_assignments_page(request, current_site))
+        all_roles = user_formset.roles
     else:
-        initial_data = [
-            {'user': user, 'role': role, 'current_site': current_site}
-            for user, role in assigned_users.iteritems()]
-        user_formset = UserFormSet(initial=initial_data, prefix='user-roles')
+        user_rows = _get_user_rows(request, current_site)
+        all_roles = list(Role.objects.all())
+
+    job = None
+    job_pk = request.GET.get('job', None)
+    if job_pk is not None:
+        job = UserSetupJob.objects.filter(
+            pk=job_pk, site=current_site).exclude(
+            status=UserSetupJob.DONE)[:1]
+        job = job[0] if job else None
 
-    all_roles = Role.objects.all()
     role_pk_to_site_wide = dict((role.pk, role.is_site_wide) for role in all_roles)
     # so that the empty form template doesn't have an 'assign pages' link
     role_pk_to_site_wide[None] = True
@@ -287,8 +686,15 @@ def user_setup(request):
         'app_label': 'Cmsroles',
         'administered_sites': administered_sites,
         'current_site': current_site,
-        'user_formset': user_formset,
-        'page_formsets': page_formsets,
+        'user_rows': user_rows,
+        'roles': all_roles,
+        'filters': dict((key, request.GET.get(key, ''))
+                        for key in ('role', 'q')),
+        'filters_query': urlencode(dict(
+                [('site', current_site.pk)] +
+                [(key, request.GET[key]) for key in ('role', 'q')
+                 if request.GET.get(key)])),
+        'job': job,
         'user': request.user,
         'role_pk_to_site_wide_js': [
             (role.pk, 'true' if role.is_site_wide else 'false')
@@ -296,3 +702,211 @@ def user_setup(request):
         'role_pk_to_site_wide': role_pk_to_site_wide}
     return render_to_response('admin/cmsroles/user_setup.html', context,
                               context_instance=RequestContext(request))
+
+
+@user_passes_test(is_site_admin, login_url='/admin/')
+def user_setup_job_status(request):
+    """Returns the progress of a background user setup job. This is
+    meant to be polled via AJAX while the job is running.
+    """
+    administered_sites = get_cached_administered_sites_queryset(request.user)
+    try:
+        job = UserSetupJob.objects.get(
+            pk=int(request.GET.get('job', '')),
+            site__in=administered_sites)
+    except (ValueError, UserSetupJob.DoesNotExist):
+        raise PermissionDenied()
+    response = {'status': job.status,
+                'finished': job.finished,
+                'done': job.done,
+                'total': job.total,
+                'error': job.error}
+    return HttpResponse(simplejson.dumps(response),
+                        content_type="application/json")
+
+
+def _get_requested_site_version(request):
+    """Returns the requested site along with the version and the time of
+    the last change of its assignments. Looked up once per request."""
+    if not hasattr(request, '_cmsroles_site_version'):
+        current_site, administered_sites = _get_user_sites(
+            request.user, _get_site_pk(request))
+        request._cmsroles_site_version = (
+            (current_site, ) + tuple(get_site_version(current_site)))
+    return request._cmsroles_site_version
+
+
+def _site_assignments_etag(request):
+    current_site, version, modified = _get_requested_site_version(request)
+    return '%d-%d' % (current_site.pk, version)
+
+
+def _site_assignments_last_modified(request):
+    current_site, version, modified = _get_requested_site_version(request)
+    return modified
+
+
+def _get_user_page_grants(site, user_pks):
+    """Returns a user pk -> page pks mapping of the pages the given users
+    got through page based roles on site"""
+    PagePermissions = Role.derived_page_permissions.through
+    user_pages = {}
+    for user_pks_chunk in chunked(user_pks):
+        rows = PagePermissions.objects.filter(
+            pagepermission__page__site=site,
+            pagepermission__user__in=user_pks_chunk).values_list(
+            'pagepermission__user', 'pagepermission__page')
+        for user_pk, page_pk in rows:
+            user_pages.setdefault(user_pk, []).append(page_pk)
+    return user_pages
+
+
+@user_passes_test(is_site_admin, login_url='/admin/')
+@condition(etag_func=_site_assignments_etag,
+           last_modified_func=_site_assignments_last_modified)
+def site_assignments(request):
+    """Returns a page of a site's role assignments as JSON. Each user is
+    a list of the values named by 'fields'. Responses carry the site's
+    assignments version so unchanged sites get a 304 Not Modified
+    without the assignments being looked up.
+    """
+    current_site, version, modified = _get_requested_site_version(request)
+    rows = sorted(get_site_user_rows(current_site))
+    paginator = Paginator(rows, SITE_ASSIGNMENTS_PAGE_SIZE)
+    try:
+        assignments_page = paginator.page(request.GET.get('page', 1))
+    except (PageNotAnInteger, EmptyPage):
+        raise Http404
+    roles = Role.objects.filter(
+        pk__in=set(row[3] for row in assignments_page.object_list))\
+        .values_list('pk', 'name', 'is_site_wide')
+    page_based_role_pks = set(
+        pk for pk, name, is_site_wide in roles if not is_site_wide)
+    user_pages = _get_user_page_grants(current_site, [
+            row[0] for row in assignments_page.object_list
+            if row[3] in page_based_role_pks])
+    response = {
+        'site': current_site.pk,
+        'version': version,
+        'page': assignments_page.number,
+        'num_pages': paginator.num_pages,
+        'count': paginator.count,
+        'roles': dict((pk, {'name': name, 'is_site_wide': is_site_wide})
+                      for pk, name, is_site_wide in roles),
+        'fields': ['id', 'username', 'email', 'role', 'pages'],
+        'users': [[user_pk, username, email, role_pk,
+                   sorted(user_pages.get(user_pk, []))]
+                  for user_pk, username, email, role_pk
+                  in assignments_page.object_list]}
+    return HttpResponse(simplejson.dumps(response, separators=(',', ':')),
+                        content_type="application/json")
+
+
+def _get_page_titles(page_pks):
+    """Returns a page pk -> title mapping, preferring the titles in the
+    current language"""
+    language = get_language()
+    titles = {}
+    for pks_chunk in chunked(page_pks):
+        title_rows = Title.objects.filter(page__in=pks_chunk).values_list(
+            'page', 'language', 'title')
+        for page_pk, title_language, title in title_rows:
+            if page_pk not in titles or title_language == language:
+                titles[page_pk] = title
+    return titles
+
+
+@user_passes_test(is_site_admin, login_url='/admin/')
+def get_page_tree(request):
+    """Returns the children of the 'parent' page of the current site or
+    its root pages when no parent is given. This is meant to be called
+    via AJAX by the page pickers, which expand the page tree lazily.
+    """
+    current_site, administered_sites = _get_user_sites(
+        request.user, _get_site_pk(request))
+    pages = Page.objects.filter(site=current_site)
+    parent_pk = request.GET.get('parent', None)
+    if parent_pk:
+        try:
+            parent = pages.values('tree_id', 'lft', 'rght', 'level').get(
+                pk=int(parent_pk))
+        except (ValueError, Page.DoesNotExist):
+            raise Http404
+        pages = pages.filter(
+            tree_id=parent['tree_id'], lft__gt=parent['lft'],
+            rght__lt=parent['rght'], level=parent['level'] + 1)
+    else:
+        pages = pages.filter(level=0)
+    rows = list(pages.order_by('tree_id', 'lft').values_list(
+            'pk', 'lft', 'rght'))
+    titles = _get_page_titles([pk for pk, lft, rght in rows])
+    response = {'nodes': [{'id': pk,
+                           'text': titles.get(pk, unicode(pk)),
+                           'has_children': rght - lft > 1}
+                          for pk, lft, rght in rows]}
+    return HttpResponse(simplejson.dumps(response),
+                        content_type="application/json")
+
+
+@user_passes_test(is_site_admin, login_url='/admin/')
+def search_users(request):
+    """Returns a page of the active users whose username, email or name
+    start with the 'q' parameter. This is meant to be called via AJAX by
+    the user select boxes of the user setup page.
+
+    The lookups are case insensitive, so they only avoid scanning the
+    user table when the database has matching indexes, like the
+    expression indexes the README lists for PostgreSQL.
+    """
+    term = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    users = User.objects.filter(is_active=True)
+    if term:
+        users = users.filter(
+            Q(username__istartswith=term) | Q(email__istartswith=term) |
+            Q(first_name__istartswith=term) | Q(last_name__istartswith=term))
+    offset = (page - 1) * USER_SEARCH_PAGE_SIZE
+    # one extra user tells whether there's a next page
+    users = list(users.order_by('username').only(
+            'username', 'email', 'first_name', 'last_name')[
+            offset:offset + USER_SEARCH_PAGE_SIZE + 1])
+    response = {
+        'results': [{'id': user.pk, 'text': _get_user_label(user)}
+                    for user in users[:USER_SEARCH_PAGE_SIZE]],
+        'more': len(users) > USER_SEARCH_PAGE_SIZE}
+    return HttpResponse(simplejson.dumps(response),
+                        content_type="application/json")
+
+
+@user_passes_test(is_site_admin, login_url='/admin/')
+def export_assignments(request):
+    """Streams the role assignments on the administered sites, or only on
+    the ones given by the 'site' parameters, as CSV or JSON Lines. The
+    'role' parameters limit the export to some of the roles.
+    """
+    format = request.GET.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest(u'Unknown format: %s' % format)
+    site_ids = set(filter(None, map(_to_pk, request.GET.getlist('site'))))
+    role_ids = set(filter(None, map(_to_pk, request.GET.getlist('role'))))
+    if request.user.is_superuser:
+        # superusers administer all sites, unknown ones just export nothing
+        site_ids = site_ids or None
+    else:
+        administered_site_ids = get_administered_site_ids(request.user)
+        if not site_ids:
+            site_ids = administered_site_ids
+        elif not site_ids <= administered_site_ids:
+            raise PermissionDenied()
+    iter_lines, content_type = EXPORT_FORMATS[format]
+    rows = iter_assignments(
+        sorted(site_ids) if site_ids is not None else None,
+        role_ids or None)
+    # the response's content is only generated while it's being sent
+    response = HttpResponse(iter_lines(rows), content_type=content_type)
+    response['Content-Disposition'] = \
+        'attachment; filename=role_assignments.%s' % format
+    return response